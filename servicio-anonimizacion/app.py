@@ -1,10 +1,25 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 import requests
+import requests.adapters
 import hashlib
+import hmac
 import uuid
 from datetime import datetime
 import os
+import random
+import csv
+import io
+import json
 from enum import Enum
+from functools import lru_cache, partial
+from collections import Counter, OrderedDict, defaultdict
+import heapq
+import bisect
+import threading
+import time
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 app = Flask(__name__)
 
@@ -12,33 +27,1076 @@ app = Flask(__name__)
 SERVICE_NAME = "Servicio de Anonimización"
 VERSION = "1.0.0"
 
-def anonimizar_datos(datos):
+# Campos sensibles y la regla que se les aplica
+CAMPOS_HASH = ['nombre', 'email', 'dni', 'telefono', 'direccion']
+CAMPOS_RUIDO = ['edad', 'salario', 'ingresos']
+
+# Límite de registros aceptados por petición en /anonimizar/lote
+LOTE_MAX_REGISTROS = int(os.getenv('LOTE_MAX_REGISTROS', 10000))
+
+# Procesos auxiliares por worker para lotes grandes (0 = desactivado)
+FLASK_PROCESOS_LOTE = int(os.getenv('FLASK_PROCESOS_LOTE', 0))
+# Registros a partir de los cuales un lote se reparte entre esos procesos
+LOTE_UMBRAL_PROCESOS = int(os.getenv('LOTE_UMBRAL_PROCESOS', 2000))
+
+# Tamaño de los bloques leídos/escritos por /anonimizar/stream
+STREAM_CHUNK_BYTES = int(os.getenv('STREAM_CHUNK_BYTES', 64 * 1024))
+
+# Máximo de clases de equivalencia devueltas en el detalle de /verificar/k-anonimity
+K_ANON_MAX_CLASES = int(os.getenv('K_ANON_MAX_CLASES', 100))
+# Tamaño de muestra por defecto del modo "estimacion"
+K_ANON_MUESTRA = int(os.getenv('K_ANON_MUESTRA', 10000))
+
+# Presupuesto de nodos del retículo antes de pasar a búsqueda voraz
+GENERALIZACION_MAX_NODOS = int(os.getenv('GENERALIZACION_MAX_NODOS', 200))
+# Con más clases originales que este umbral, 'auto' usa Mondrian en lugar del retículo
+GENERALIZACION_RETICULO_MAX_CLASES = int(os.getenv('GENERALIZACION_RETICULO_MAX_CLASES', 5000))
+# Clases de equivalencia memorizadas (en total) durante la búsqueda
+GENERALIZACION_MEMO_MAX = int(os.getenv('GENERALIZACION_MEMO_MAX', 2000000))
+
+SELA_SERVICE_URL = os.getenv('SELA_SERVICE_URL', 'http://servicio-sela:8000')
+# Timeout (s) de las reservas de cuota en servicio-sela
+RESERVA_TIMEOUT = float(os.getenv('RESERVA_TIMEOUT', 2))
+# Registros de cuota que cada worker reserva de una vez por acuerdo y admite localmente
+CUOTA_BLOQUE = int(os.getenv('CUOTA_BLOQUE', 100))
+# Segundos sin uso tras los que la cuota reservada y no usada se devuelve a servicio-sela
+CUOTA_CONCESION_TTL = float(os.getenv('CUOTA_CONCESION_TTL', 30))
+# Registros reservados de una vez en /anonimizar/stream
+STREAM_RESERVA_BLOQUE = int(os.getenv('STREAM_RESERVA_BLOQUE', 1000))
+# Ventana (s) en la que se agrupan las devoluciones de cuota de un mismo acuerdo
+NOTIFICADOR_VENTANA = float(os.getenv('NOTIFICADOR_VENTANA', 0.5))
+NOTIFICADOR_MAX_REINTENTOS = int(os.getenv('NOTIFICADOR_MAX_REINTENTOS', 10))
+
+# Clave maestra HMAC de la que se derivan las claves de cada acuerdo
+SEUDONIMIZACION_CLAVE = os.getenv('SEUDONIMIZACION_CLAVE')
+# Valores de ejemplo publicados en versiones anteriores de docker-compose.yml
+CLAVES_PUBLICAS = {'cambiar-en-produccion'}
+if SEUDONIMIZACION_CLAVE in CLAVES_PUBLICAS:
+    # Con una clave conocida cualquiera puede recalcular los tokens de un DNI o un email
+    raise RuntimeError("SEUDONIMIZACION_CLAVE tiene un valor de ejemplo público; define una clave secreta")
+if not SEUDONIMIZACION_CLAVE:
+    # Sin clave configurada los tokens solo son estables durante la vida del proceso
+    print("AVISO: SEUDONIMIZACION_CLAVE no definida, se usa una clave aleatoria")
+    SEUDONIMIZACION_CLAVE = os.urandom(32).hex()
+
+# Número máximo de pares valor->token memorizados
+SEUDONIMIZACION_CACHE_MAX = int(os.getenv('SEUDONIMIZACION_CACHE_MAX', 100000))
+
+@lru_cache(maxsize=1024)
+def _clave_acuerdo(acuerdo_id):
+    """Deriva la clave HMAC de un acuerdo a partir de la clave maestra"""
+    return hmac.new(SEUDONIMIZACION_CLAVE.encode(), (acuerdo_id or '').encode(), hashlib.sha256).digest()
+
+@lru_cache(maxsize=SEUDONIMIZACION_CACHE_MAX)
+def _token_seudonimo(acuerdo_id, valor):
+    """Token HMAC-SHA256 de un valor; memorizado en una caché LRU acotada"""
+    hash_valor = hmac.new(_clave_acuerdo(acuerdo_id), valor.encode(), hashlib.sha256).hexdigest()[:12]
+    return f"ANON_{hash_valor}"
+
+def estadisticas_seudonimizacion():
+    """Aciertos/fallos de la caché de tokens para /info"""
+    cache = _token_seudonimo.cache_info()
+    consultas = cache.hits + cache.misses
+    return {
+        'algoritmo': 'HMAC-SHA256 con clave por acuerdo',
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'tasa_acierto': round(cache.hits / consultas, 4) if consultas else 0.0,
+        'tamano': cache.currsize,
+        'capacidad': cache.maxsize
+    }
+
+def _seudonimizar(valor, acuerdo_id=None):
+    """Sustituye un string sensible por un token HMAC determinístico dentro del acuerdo"""
+    if isinstance(valor, str):
+        # Mismo valor y mismo acuerdo -> mismo token, para mantener consistencia
+        return _token_seudonimo(acuerdo_id, valor)
+    return valor
+
+def _agregar_ruido(valor, acuerdo_id=None):
+    """Para números sensibles, agregar ruido"""
+    if isinstance(valor, (int, float)):
+        ruido = random.uniform(-0.1, 0.1) * valor
+        return round(valor + ruido, 2)
+    return valor
+
+def _regla_campo(campo):
+    """Devuelve la regla de anonimización de un campo (None si no es sensible)"""
+    nombre = campo.lower()
+    if nombre in CAMPOS_HASH:
+        return _seudonimizar
+    if nombre in CAMPOS_RUIDO:
+        return _agregar_ruido
+    return None
+
+def anonimizar_datos(datos, acuerdo_id=None):
     """
     Función para anonimizar datos sensibles
     """
     datos_anonimizados = {}
     
     for campo, valor in datos.items():
-        if isinstance(valor, str):
-            # Anonimizar strings sensibles con hash
-            if campo.lower() in ['nombre', 'email', 'dni', 'telefono', 'direccion']:
-                # Generar hash determinístico para mantener consistencia
-                hash_valor = hashlib.sha256(valor.encode()).hexdigest()[:12]
-                datos_anonimizados[campo] = f"ANON_{hash_valor}"
+        regla = _regla_campo(campo)
+        datos_anonimizados[campo] = regla(valor, acuerdo_id) if regla else valor
+    
+    return datos_anonimizados
+
+def anonimizar_columna(campo, valores, acuerdo_id=None):
+    """
+    Aplica la regla de un campo a todos los valores de una columna.
+    La regla se resuelve una sola vez y los strings repetidos se hashean una vez.
+    """
+    regla = _regla_campo(campo)
+    if regla is None:
+        return list(valores)
+    if regla is _seudonimizar:
+        tokens = {}
+        resultado = []
+        for valor in valores:
+            if isinstance(valor, str):
+                token = tokens.get(valor)
+                if token is None:
+                    token = tokens[valor] = _seudonimizar(valor, acuerdo_id)
+                resultado.append(token)
             else:
-                datos_anonimizados[campo] = valor
-        elif isinstance(valor, (int, float)):
-            # Para números sensibles, agregar ruido
-            if campo.lower() in ['edad', 'salario', 'ingresos']:
-                import random
-                ruido = random.uniform(-0.1, 0.1) * valor
-                datos_anonimizados[campo] = round(valor + ruido, 2)
+                resultado.append(valor)
+        return resultado
+    return [regla(valor, acuerdo_id) for valor in valores]
+
+def anonimizar_lote(registros, acuerdo_id=None):
+    """
+    Anonimiza una lista de registros columna a columna.
+    Devuelve (datos_anonimizados, errores); los registros con error quedan a None.
+    """
+    errores = {}
+    resultados = {}
+    columnas = {}
+
+    # 1. Validar registros y trasponerlos a columnas
+    for indice, registro in enumerate(registros):
+        if not isinstance(registro, dict):
+            errores[indice] = 'El registro debe ser un objeto JSON'
+            continue
+        if not registro:
+            errores[indice] = 'No se proporcionaron datos'
+            continue
+        # Mantener el orden original de los campos del registro
+        resultados[indice] = dict.fromkeys(registro)
+        for campo, valor in registro.items():
+            indices, valores = columnas.setdefault(campo, ([], []))
+            indices.append(indice)
+            valores.append(valor)
+
+    # 2. Anonimizar cada columna de una vez
+    for campo, (indices, valores) in columnas.items():
+        try:
+            anonimizados = anonimizar_columna(campo, valores, acuerdo_id)
+        except Exception:
+            # Si la columna falla, se reintenta campo a campo para aislar el registro culpable
+            anonimizados = []
+            for indice, valor in zip(indices, valores):
+                try:
+                    anonimizados.append(anonimizar_datos({campo: valor}, acuerdo_id)[campo])
+                except Exception as e:
+                    errores.setdefault(indice, f"Campo '{campo}': {str(e)}")
+                    anonimizados.append(None)
+        for indice, valor in zip(indices, anonimizados):
+            resultados[indice][campo] = valor
+
+    datos_anonimizados = [
+        None if indice in errores else resultados[indice]
+        for indice in range(len(registros))
+    ]
+    lista_errores = [
+        {'indice': indice, 'error': mensaje}
+        for indice, mensaje in sorted(errores.items())
+    ]
+    return datos_anonimizados, lista_errores
+
+def _leer_lineas(stream, tamano_bloque=STREAM_CHUNK_BYTES):
+    """Lee un flujo binario por bloques y genera sus líneas (con salto de línea)"""
+    pendiente = b''
+    while True:
+        bloque = stream.read(tamano_bloque)
+        if not bloque:
+            break
+        pendiente += bloque
+        *lineas, pendiente = pendiente.split(b'\n')
+        for linea in lineas:
+            yield linea.decode('utf-8') + '\n'
+    if pendiente:
+        yield pendiente.decode('utf-8')
+
+def _registros_ndjson(lineas):
+    """Genera (indice, registro, error) a partir de líneas NDJSON"""
+    indice = 0
+    for linea in lineas:
+        if not linea.strip():
+            continue
+        try:
+            registro = json.loads(linea)
+        except ValueError as e:
+            yield indice, None, f'JSON inválido: {str(e)}'
+        else:
+            if isinstance(registro, dict):
+                yield indice, registro, None
             else:
-                datos_anonimizados[campo] = valor
+                yield indice, None, 'El registro debe ser un objeto JSON'
+        indice += 1
+
+def _convertir_numero(valor):
+    """Convierte un valor CSV a número si es posible (los CSV solo traen texto)"""
+    try:
+        return int(valor)
+    except ValueError:
+        try:
+            return float(valor)
+        except ValueError:
+            return valor
+
+def _registros_csv(lineas, cabecera=None):
+    """Genera (indice, registro, error) a partir de un CSV con cabecera.
+    Si se pasa la lista `cabecera`, se rellena con las columnas al leer la primera línea."""
+    lector = csv.DictReader(lineas)
+    if cabecera is not None:
+        cabecera.extend(lector.fieldnames or [])
+    for indice, fila in enumerate(lector):
+        if None in fila:
+            yield indice, None, 'La fila tiene más columnas que la cabecera'
+            continue
+        # Los campos numéricos sensibles deben llegar como número para recibir ruido
+        for campo, valor in fila.items():
+            if valor and campo.lower() in CAMPOS_RUIDO:
+                fila[campo] = _convertir_numero(valor)
+        yield indice, fila, None
+
+def anonimizar_flujo(registros, acuerdo_id=None):
+    """Pipeline perezoso: genera (indice, datos_anonimizados, error) registro a registro"""
+    for indice, registro, error in registros:
+        if error is None:
+            try:
+                yield indice, anonimizar_datos(registro, acuerdo_id), None
+            except Exception as e:
+                yield indice, None, str(e)
         else:
-            datos_anonimizados[campo] = valor
-    
-    return datos_anonimizados
+            yield indice, None, error
+
+def _serializar_ndjson(resultados):
+    for indice, datos, error in resultados:
+        if error is None:
+            yield json.dumps(datos, ensure_ascii=False) + '\n'
+        else:
+            yield json.dumps({'indice': indice, 'error': error}, ensure_ascii=False) + '\n'
+
+def _serializar_csv(resultados, cabecera):
+    # Una fila de salida por fila de entrada: las filas con error van en su posición,
+    # con los campos vacíos y el motivo en la columna final _error (como las líneas
+    # {"indice", "error"} del NDJSON). Las columnas son las de la cabecera de entrada
+    # (anonimizar no las cambia), así que cada fila se escribe en cuanto llega.
+    buffer = io.StringIO()
+    escritor = None
+
+    def volcar():
+        contenido = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return contenido
+
+    for indice, datos, error in resultados:
+        if escritor is None:
+            escritor = csv.DictWriter(buffer, fieldnames=cabecera + ['_error'], extrasaction='ignore')
+            escritor.writeheader()
+        escritor.writerow(datos if error is None else {'_error': error})
+        yield volcar()
+
+def _agrupar_bloques(fragmentos, tamano_bloque=STREAM_CHUNK_BYTES):
+    """Agrupa fragmentos de texto en bloques para no emitir un chunk HTTP por fila"""
+    bloque = []
+    tamano = 0
+    for fragmento in fragmentos:
+        bloque.append(fragmento)
+        tamano += len(fragmento)
+        if tamano >= tamano_bloque:
+            yield ''.join(bloque)
+            bloque = []
+            tamano = 0
+    if bloque:
+        yield ''.join(bloque)
+
+def registros_a_columnas(registros, campos=None):
+    """Convierte una lista de registros en columnas {campo: [valores]}"""
+    if campos is None:
+        campos = list(dict.fromkeys(campo for registro in registros for campo in registro))
+    return {campo: [registro.get(campo) for registro in registros] for campo in campos}
+
+def _valor_agrupable(valor):
+    # Listas y objetos JSON no son hashables; se agrupan por su serialización
+    if isinstance(valor, (list, dict)):
+        return json.dumps(valor, sort_keys=True, default=str)
+    return valor
+
+def _contar_clases(columnas_qi):
+    """Tamaño de cada clase de equivalencia (agrupación por hash de la tupla de cuasi-identificadores)"""
+    try:
+        return Counter(zip(*columnas_qi))
+    except TypeError:
+        return Counter(zip(*[[_valor_agrupable(v) for v in columna] for columna in columnas_qi]))
+
+def verificar_k_anonimato(columnas, cuasi_identificadores, k, atributo_sensible=None, l=None,
+                          muestra=None, max_clases=K_ANON_MAX_CLASES):
+    """
+    Calcula las clases de equivalencia de un conjunto de datos en formato columnar.
+    Con muestra se trabaja sobre una muestra aleatoria y los tamaños de clase se extrapolan.
+    """
+    total = len(columnas[cuasi_identificadores[0]])
+    columnas_qi = [columnas[campo] for campo in cuasi_identificadores]
+    columna_sensible = columnas.get(atributo_sensible) if atributo_sensible else None
+    factor = 1.0
+
+    if muestra and muestra < total:
+        indices = sorted(random.sample(range(total), muestra))
+        columnas_qi = [[columna[i] for i in indices] for columna in columnas_qi]
+        if columna_sensible is not None:
+            columna_sensible = [columna_sensible[i] for i in indices]
+        factor = total / muestra
+
+    clases = _contar_clases(columnas_qi)
+    if factor != 1.0:
+        # Estimación: cada registro de la muestra representa `factor` registros reales
+        clases = {clave: round(n * factor, 2) for clave, n in clases.items()}
+    tamano_minimo = min(clases.values()) if clases else 0
+    violaciones = sorted(
+        ((clave, n) for clave, n in clases.items() if n < k),
+        key=lambda item: item[1]
+    )
+
+    resultado = {
+        'total_registros': total,
+        'registros_analizados': len(columnas_qi[0]),
+        'cuasi_identificadores': cuasi_identificadores,
+        'total_clases': len(clases),
+        'k_minimo': tamano_minimo,
+        'cumple_k': tamano_minimo >= k,
+        'clases_violan_k': len(violaciones),
+        'registros_en_riesgo': round(sum(n for _, n in violaciones)),
+        'detalle_violaciones': [
+            {'valores': dict(zip(cuasi_identificadores, clave)), 'tamano': n}
+            for clave, n in violaciones[:max_clases]
+        ]
+    }
+
+    if columna_sensible is not None:
+        valores_por_clase = defaultdict(set)
+        for clave, valor in zip(zip(*columnas_qi), map(_valor_agrupable, columna_sensible)):
+            valores_por_clase[clave].add(valor)
+        l_requerido = l or 2
+        diversidad = {clave: len(valores) for clave, valores in valores_por_clase.items()}
+        violaciones_l = [clave for clave, n in diversidad.items() if n < l_requerido]
+        resultado['l_diversidad'] = {
+            'atributo_sensible': atributo_sensible,
+            'l_requerido': l_requerido,
+            'l_minimo': min(diversidad.values()) if diversidad else 0,
+            'cumple_l': len(violaciones_l) == 0,
+            'clases_violan_l': len(violaciones_l)
+        }
+
+    return resultado
+
+# --- GENERALIZACIÓN / SUPRESIÓN (nivel k_anonimato) ---
+
+def _nivel_rango(anchura):
+    def generalizar(valor):
+        try:
+            numero = float(valor)
+        except (TypeError, ValueError):
+            return '*'
+        inicio = int(numero // anchura * anchura)
+        return f"{inicio}-{inicio + anchura - 1}"
+    return generalizar
+
+def _nivel_prefijo(ocultos):
+    def generalizar(valor):
+        if valor is None:
+            return '*'
+        texto = str(valor)
+        visibles = max(len(texto) - ocultos, 0)
+        return texto[:visibles] + '*' * (len(texto) - visibles)
+    return generalizar
+
+def _nivel_fecha(longitud):
+    def generalizar(valor):
+        # Fechas ISO: YYYY-MM-DD -> YYYY-MM -> YYYY
+        return str(valor)[:longitud] if valor else '*'
+    return generalizar
+
+def _suprimir(valor):
+    return '*'
+
+def construir_jerarquia(spec):
+    """
+    Devuelve la lista de funciones de generalización de una columna, del nivel 0
+    (valor original) al nivel máximo (supresión total '*').
+    """
+    tipo = spec.get('tipo')
+    niveles = [lambda valor: valor]
+    if tipo == 'rango':
+        anchuras = spec.get('anchuras') or [5, 10, 20]
+        if any(not isinstance(a, (int, float)) or a <= 0 for a in anchuras):
+            raise ValueError("'anchuras' debe ser una lista de números positivos")
+        niveles += [_nivel_rango(a) for a in anchuras]
+    elif tipo == 'prefijo':
+        longitud = int(spec.get('longitud', 5))
+        niveles += [_nivel_prefijo(i) for i in range(1, longitud)]
+    elif tipo == 'fecha':
+        niveles += [_nivel_fecha(7), _nivel_fecha(4)]
+    elif tipo != 'supresion':
+        raise ValueError(f"Tipo de jerarquía desconocido: '{tipo}' (rango, prefijo, fecha, supresion)")
+    niveles.append(_suprimir)
+    return niveles
+
+class _ReticuloGeneralizacion:
+    """
+    Retículo de generalización de dominio completo sobre los cuasi-identificadores.
+    Los recuentos por clase de cada nodo se memorizan y se obtienen agregando
+    los de un nodo hijo ya evaluado (roll-up), sin volver a recorrer los registros.
+    """
+
+    def __init__(self, columnas, jerarquias, k, max_suprimidos):
+        self.k = k
+        self.max_suprimidos = max_suprimidos
+        self.jerarquias = jerarquias
+        self.alturas = [len(niveles) - 1 for niveles in jerarquias]
+        self.frecuencias = [Counter(columna) for columna in columnas]
+        self.distintos = [frecuencia.keys() for frecuencia in self.frecuencias]
+        self.base = _contar_clases(columnas)
+        self.mapas = {}
+        self.cotas = {}
+        self.memo = OrderedDict()
+        self.memo_tamano = 0
+        self.evaluados = 0
+
+    def mapa(self, j, nivel):
+        """Valor original -> valor generalizado de la columna j en un nivel"""
+        clave = (j, nivel)
+        if clave not in self.mapas:
+            generalizar = self.jerarquias[j][nivel]
+            self.mapas[clave] = {valor: generalizar(valor) for valor in self.distintos[j]}
+        return self.mapas[clave]
+
+    def _mapa_rollup(self, j, nivel):
+        """Valor del nivel-1 -> valor del nivel; None si la jerarquía no está anidada"""
+        clave = (j, nivel, 'rollup')
+        if clave not in self.mapas:
+            anterior, actual = self.mapa(j, nivel - 1), self.mapa(j, nivel)
+            rollup = {}
+            for valor in self.distintos[j]:
+                if rollup.setdefault(anterior[valor], actual[valor]) != actual[valor]:
+                    rollup = None
+                    break
+            self.mapas[clave] = rollup
+        return self.mapas[clave]
+
+    def recuentos(self, nodo):
+        if nodo in self.memo:
+            self.memo.move_to_end(nodo)
+            return self.memo[nodo]
+        recuento = {}
+        anterior = recuento.get
+        # Roll-up desde el hijo memorizado con menos clases; si no hay, desde la base
+        hijos = [
+            (len(self.memo[hijo]), j, hijo)
+            for j, nivel in enumerate(nodo) if nivel
+            for hijo in [nodo[:j] + (nivel - 1,) + nodo[j + 1:]]
+            if hijo in self.memo and self._mapa_rollup(j, nivel) is not None
+        ]
+        if hijos:
+            _, j, hijo = min(hijos)
+            rollup = self._mapa_rollup(j, nodo[j])
+            for clase, n in self.memo[hijo].items():
+                clave = clase[:j] + (rollup[clase[j]],) + clase[j + 1:]
+                recuento[clave] = anterior(clave, 0) + n
+        else:
+            mapas = [self.mapa(j, nivel) for j, nivel in enumerate(nodo)]
+            for clase, n in self.base.items():
+                clave = tuple([m[v] for m, v in zip(mapas, clase)])
+                recuento[clave] = anterior(clave, 0) + n
+        self.evaluados += 1
+        self.memo[nodo] = recuento
+        self.memo_tamano += len(recuento)
+        while self.memo_tamano > GENERALIZACION_MEMO_MAX and len(self.memo) > 1:
+            _, antiguo = self.memo.popitem(last=False)
+            self.memo_tamano -= len(antiguo)
+        return recuento
+
+    def cota_suprimidos(self, nodo):
+        """
+        Cota inferior barata de los suprimidos de un nodo: un registro cuyo valor
+        generalizado aparece menos de k veces en su propia columna nunca podrá
+        estar en una clase de tamaño >= k (propiedad de subconjuntos de Incognito).
+        """
+        return max(self._cota_columna(j, nivel) for j, nivel in enumerate(nodo))
+
+    def _cota_columna(self, j, nivel):
+        if (j, nivel) not in self.cotas:
+            recuento = Counter()
+            mapa = self.mapa(j, nivel)
+            for valor, n in self.frecuencias[j].items():
+                recuento[mapa[valor]] += n
+            self.cotas[(j, nivel)] = sum(n for n in recuento.values() if n < self.k)
+        return self.cotas[(j, nivel)]
+
+    def suprimidos(self, nodo):
+        return sum(n for n in self.recuentos(nodo).values() if n < self.k)
+
+    def perdida(self, nodo):
+        """Pérdida de información: altura de generalización normalizada media"""
+        return sum(nivel / altura for nivel, altura in zip(nodo, self.alturas)) / len(nodo)
+
+    def padres(self, nodo):
+        for j, nivel in enumerate(nodo):
+            if nivel < self.alturas[j]:
+                yield nodo[:j] + (nivel + 1,) + nodo[j + 1:]
+
+    def buscar(self):
+        """
+        Búsqueda best-first por pérdida: como la pérdida crece al generalizar, el
+        primer nodo que cumple k es el de mínima pérdida. Si se agota el presupuesto
+        de nodos, se sube de forma voraz desde el mejor nodo visto.
+        """
+        # Ningún nodo que cumpla k puede tener una columna por debajo del primer
+        # nivel en el que esa columna, por sí sola, cumple la cota de supresión
+        inicio = tuple(
+            next((nivel for nivel in range(altura + 1)
+                  if self._cota_columna(j, nivel) <= self.max_suprimidos), altura)
+            for j, altura in enumerate(self.alturas)
+        )
+        frontera = [(self.perdida(inicio), inicio)]
+        vistos = {inicio}
+        mejor = (float('inf'), inicio)
+        # Las visitas a nodos podados también se acotan para tablas muy anchas
+        while (frontera and self.evaluados < GENERALIZACION_MAX_NODOS
+               and len(vistos) < GENERALIZACION_MAX_NODOS * 50):
+            _, nodo = heapq.heappop(frontera)
+            # Los nodos descartados por la cota no se evalúan, pero sí se exploran sus padres
+            if self.cota_suprimidos(nodo) <= self.max_suprimidos:
+                suprimidos = self.suprimidos(nodo)
+                if suprimidos <= self.max_suprimidos:
+                    return nodo
+                mejor = min(mejor, (suprimidos, nodo))
+            for padre in self.padres(nodo):
+                if padre not in vistos:
+                    vistos.add(padre)
+                    heapq.heappush(frontera, (self.perdida(padre), padre))
+
+        suprimidos, nodo = mejor
+        if suprimidos == float('inf'):
+            suprimidos = self.suprimidos(nodo)
+        while suprimidos > self.max_suprimidos:
+            # Elegir el padre que más reduce los suprimidos por unidad de pérdida añadida
+            candidatos = [
+                ((suprimidos - self.suprimidos(padre)) / (self.perdida(padre) - self.perdida(nodo)), padre)
+                for padre in self.padres(nodo)
+            ]
+            if not candidatos:
+                # Nodo máximo: hay menos de k registros y todos quedan suprimidos
+                break
+            _, nodo = max(candidatos)
+            suprimidos = self.suprimidos(nodo)
+        return nodo
+
+def _clave_orden(tipo):
+    """Clave de ordenación de los valores de una columna según su jerarquía"""
+    if tipo == 'rango':
+        def clave(valor):
+            try:
+                return (0, float(valor))
+            except (TypeError, ValueError):
+                return (1, 0.0)
+        return clave
+    return lambda valor: '' if valor is None else str(valor)
+
+def _resumen_mondrian(tipo, minimo, maximo):
+    """Valor generalizado de una partición a partir de sus valores extremos"""
+    if tipo == 'supresion':
+        return '*'
+    if minimo == maximo:
+        return minimo
+    if tipo == 'rango':
+        try:
+            return f"{float(minimo):g}-{float(maximo):g}"
+        except (TypeError, ValueError):
+            return '*'
+    inicio, fin = str(minimo), str(maximo)
+    comun = os.path.commonprefix([inicio, fin])
+    if tipo == 'fecha':
+        return next((comun[:n] for n in (10, 7, 4) if len(comun) >= n), '*')
+    return comun + '*' * (len(inicio) - len(comun)) if comun else '*'
+
+def _mondrian(columnas, tipos, k):
+    """
+    Mondrian estricto: divide recursivamente por la mediana de la columna con
+    mayor rango normalizado mientras ambas mitades tengan al menos k registros.
+    El coste es O(n log n) por nivel de partición, independiente del retículo.
+    Devuelve (columnas_generalizadas, numero_particiones, perdida).
+    """
+    total = len(columnas[0])
+    # Cada columna se traduce a rangos densos para comparar tipos heterogéneos
+    rangos, ordenados = [], []
+    for columna, tipo in zip(columnas, tipos):
+        distintos = sorted(set(columna), key=_clave_orden(tipo))
+        posicion = {valor: i for i, valor in enumerate(distintos)}
+        rangos.append([posicion[valor] for valor in columna])
+        ordenados.append(distintos)
+    anchos = [max(len(distintos) - 1, 1) for distintos in ordenados]
+    divisibles = [j for j, tipo in enumerate(tipos) if tipo != 'supresion' and len(ordenados[j]) > 1]
+
+    def extremos(particion, j):
+        valores = list(map(rangos[j].__getitem__, particion))
+        return min(valores), max(valores)
+
+    def dividir(particion):
+        amplitudes = {j: extremos(particion, j) for j in divisibles}
+        # Primero la columna con mayor amplitud normalizada
+        for j in sorted(divisibles, key=lambda j: (amplitudes[j][0] - amplitudes[j][1]) / anchos[j]):
+            if amplitudes[j][0] == amplitudes[j][1]:
+                return None
+            particion.sort(key=rangos[j].__getitem__)
+            claves = list(map(rangos[j].__getitem__, particion))
+            mediana = claves[len(claves) // 2]
+            # Los valores iguales a la mediana quedan siempre en la misma mitad
+            corte = bisect.bisect_left(claves, mediana) or bisect.bisect_right(claves, mediana)
+            if corte >= k and len(particion) - corte >= k:
+                return particion[:corte], particion[corte:]
+        return None
+
+    generalizadas = [[None] * total for _ in columnas]
+    particiones = 0
+    perdida = 0.0
+    pendientes = [list(range(total))] if total >= k else []
+    while pendientes:
+        particion = pendientes.pop()
+        mitades = dividir(particion)
+        if mitades:
+            pendientes.extend(mitades)
+            continue
+        particiones += 1
+        for j, tipo in enumerate(tipos):
+            minimo, maximo = extremos(particion, j)
+            valor = _resumen_mondrian(tipo, ordenados[j][minimo], ordenados[j][maximo])
+            columna = generalizadas[j]
+            for i in particion:
+                columna[i] = valor
+            amplitud = 1.0 if tipo == 'supresion' else (maximo - minimo) / anchos[j]
+            perdida += amplitud * len(particion) / (total * len(tipos))
+    return generalizadas, particiones, perdida
+
+def generalizar_k_anonimato(registros, jerarquias, k, max_supresion=0.0, algoritmo='auto'):
+    """
+    Generaliza los cuasi-identificadores de una lista de registros hasta alcanzar k.
+    'reticulo' busca la generalización de dominio completo de mínima pérdida,
+    suprimiendo como mucho max_supresion (fracción) de los registros; 'mondrian'
+    particiona por medianas y escala a tablas grandes o anchas. 'auto' elige
+    según el número de clases de equivalencia originales.
+    Devuelve (registros_generalizados, indices_suprimidos, informe).
+    """
+    if algoritmo not in ('auto', 'reticulo', 'mondrian'):
+        raise ValueError("algoritmo debe ser 'auto', 'reticulo' o 'mondrian'")
+    cuasi_identificadores = list(jerarquias)
+    niveles = [construir_jerarquia(jerarquias[campo]) for campo in cuasi_identificadores]
+    tipos = [jerarquias[campo].get('tipo') for campo in cuasi_identificadores]
+    columnas = [[_valor_agrupable(registro.get(campo)) for registro in registros]
+                for campo in cuasi_identificadores]
+    max_suprimidos = int(max_supresion * len(registros))
+
+    reticulo = None
+    if algoritmo != 'mondrian':
+        reticulo = _ReticuloGeneralizacion(columnas, niveles, k, max_suprimidos)
+        if algoritmo == 'auto' and len(reticulo.base) > GENERALIZACION_RETICULO_MAX_CLASES:
+            reticulo = None
+
+    informe = {'k_requerido': k}
+    if reticulo is not None:
+        nodo = reticulo.buscar()
+        mapas = [reticulo.mapa(j, nivel) for j, nivel in enumerate(nodo)]
+        generalizadas = [[mapa[v] for v in columna] for mapa, columna in zip(mapas, columnas)]
+        recuentos = reticulo.recuentos(nodo)
+        informe.update({
+            'algoritmo': 'reticulo',
+            'niveles': dict(zip(cuasi_identificadores, nodo)),
+            'niveles_maximos': dict(zip(cuasi_identificadores, reticulo.alturas)),
+            'perdida_informacion': round(reticulo.perdida(nodo), 4),
+            'nodos_evaluados': reticulo.evaluados
+        })
+    else:
+        generalizadas, particiones, perdida = _mondrian(columnas, tipos, k)
+        recuentos = _contar_clases(generalizadas)
+        informe.update({
+            'algoritmo': 'mondrian',
+            'particiones': particiones,
+            'perdida_informacion': round(perdida, 4)
+        })
+
+    resultado = []
+    suprimidos = []
+    for indice, (registro, clase) in enumerate(zip(registros, zip(*generalizadas))):
+        if recuentos[clase] < k:
+            suprimidos.append(indice)
+            resultado.append(None)
+            continue
+        generalizado = dict(registro)
+        generalizado.update(zip(cuasi_identificadores, clase))
+        resultado.append(generalizado)
+
+    clases_validas = [n for n in recuentos.values() if n >= k]
+    informe['k_alcanzado'] = min(clases_validas) if clases_validas else 0
+    informe['registros_suprimidos'] = len(suprimidos)
+    return resultado, suprimidos, informe
+
+class UsoDenegado(Exception):
+    """servicio-sela no admite el uso: no se debe anonimizar"""
+
+    def __init__(self, status, detalle):
+        super().__init__(str(detalle))
+        self.status = status
+        self.detalle = detalle
+
+    def respuesta(self):
+        return jsonify({
+            'status': 'error',
+            'mensaje': 'BLOQUEADO: el acuerdo no admite este uso',
+            'detalle': self.detalle
+        }), self.status
+
+class NotificadorContador:
+    """
+    Contabilidad del uso de cada acuerdo en servicio-sela.
+
+    Cada worker reserva la cuota por bloques de CUOTA_BLOQUE registros y admite
+    las peticiones contra lo que tiene reservado, sin ir a servicio-sela. Solo
+    espera a servicio-sela cuando no le queda cuota para la petición (el primer
+    uso de un acuerdo o un bloque agotado); cuando lo reservado baja de medio
+    bloque, el hilo de fondo pide otro. Si servicio-sela rechaza esa recarga
+    porque el acuerdo ya no está activo o ha caducado, se anula lo reservado.
+    La cuota sin usar durante CUOTA_CONCESION_TTL segundos y la no aprovechada
+    se devuelven en segundo plano: las devoluciones se acumulan por acuerdo_id
+    durante una ventana corta y se envían como un único delta con una sesión
+    HTTP keep-alive; los fallos se reintentan con backoff exponencial.
+    """
+
+    def __init__(self, url_base, ventana, max_reintentos, bloque, ttl):
+        self.url_base = url_base
+        self.ventana = ventana
+        self.max_reintentos = max_reintentos
+        self.bloque = bloque
+        self.ttl = ttl
+        # acuerdo_id -> [registros reservados sin usar, último uso (monotonic)]
+        self.concesiones = {}
+        self.recargas = set()
+        self.pendientes = {}
+        self.reintentos = {}
+        self.condicion = threading.Condition()
+        self.pid = None
+        self.sesion = None
+        self.estadisticas = {'reservados': 0, 'reservas_denegadas': 0, 'admitidos_locales': 0, 'recargas': 0,
+                             'concesiones_anuladas': 0, 'encolados': 0, 'enviados': 0,
+                             'peticiones': 0, 'fallidos': 0, 'descartados': 0}
+
+    def _arrancar(self):
+        # El hilo y la sesión se crean en cada proceso (los workers pre-fork no heredan hilos)
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.concesiones, self.recargas, self.pendientes, self.reintentos = {}, set(), {}, {}
+            self.sesion = requests.Session()
+            adaptador = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4)
+            self.sesion.mount('http://', adaptador)
+            self.sesion.mount('https://', adaptador)
+            threading.Thread(target=self._bucle, name='notificador-contador', daemon=True).start()
+
+    def _pedir(self, acuerdo_id, cantidad, reserva=None):
+        """Reserva `cantidad` en servicio-sela; lanza UsoDenegado si no se admite"""
+        params = {'cantidad': cantidad}
+        if reserva:
+            params['reserva'] = reserva
+        try:
+            r = self.sesion.post(f"{self.url_base}/api/v1/acuerdo/{acuerdo_id}/incrementar",
+                                 params=params, timeout=RESERVA_TIMEOUT)
+        except requests.RequestException as e:
+            # Sin confirmación de la cuota no se procesa nada
+            raise UsoDenegado(503, f'No se pudo reservar la cuota en servicio-sela: {e}')
+        if r.status_code != 200:
+            with self.condicion:
+                self.estadisticas['reservas_denegadas'] += 1
+            try:
+                detalle = r.json().get('detail')
+            except ValueError:
+                detalle = None
+            raise UsoDenegado(r.status_code if r.status_code in (403, 404) else 503,
+                              detalle or f'servicio-sela respondió {r.status_code}')
+        with self.condicion:
+            self.estadisticas['reservados'] += cantidad
+
+    def _tomar(self, acuerdo_id, cantidad):
+        """Descuenta `cantidad` de lo reservado por el worker; False si no alcanza (con el lock)"""
+        concesion = self.concesiones.get(acuerdo_id)
+        if concesion is None or concesion[0] < cantidad:
+            return False
+        concesion[0] -= cantidad
+        concesion[1] = time.monotonic()
+        self.estadisticas['admitidos_locales'] += cantidad
+        if concesion[0] < self.bloque / 2 and acuerdo_id not in self.recargas:
+            self.recargas.add(acuerdo_id)
+            self.condicion.notify()
+        return True
+
+    def reservar(self, acuerdo_id, cantidad, reserva=None):
+        """Consume `cantidad` de la cuota del acuerdo; lanza UsoDenegado si no se admite.
+
+        `reserva` es el id con el que servicio-sela ya reservó ese uso (/ejecutar):
+        se consume allí, porque servicio-sela la libera al recibir la respuesta.
+        """
+        with self.condicion:
+            self._arrancar()
+            if not reserva and self._tomar(acuerdo_id, cantidad):
+                return
+            disponibles = self.concesiones.get(acuerdo_id, (0, 0.0))[0]
+        if reserva:
+            self._pedir(acuerdo_id, cantidad, reserva)
+            return
+        # Sin cuota local suficiente se espera a servicio-sela: la petición más un bloque,
+        # o lo que le quede al acuerdo si, junto con lo reservado, alcanza
+        pedido = cantidad + self.bloque
+        try:
+            self._pedir(acuerdo_id, pedido)
+        except UsoDenegado as e:
+            restante = e.detalle.get('restante') if isinstance(e.detalle, dict) else None
+            if not restante or restante + disponibles < cantidad:
+                raise
+            pedido = restante
+            self._pedir(acuerdo_id, pedido)
+        with self.condicion:
+            concesion = self.concesiones.setdefault(acuerdo_id, [0, time.monotonic()])
+            concesion[0] += pedido
+            if not self._tomar(acuerdo_id, cantidad):
+                # Otra petición consumió lo reservado entretanto: lo que quede vuelve a servicio-sela
+                self._liberar_concesion(acuerdo_id)
+                self.condicion.notify()
+                raise UsoDenegado(403, {'motivo': 'cuota_agotada', 'mensaje': 'Cuota insuficiente para la petición'})
+
+    def devolver(self, acuerdo_id, cantidad):
+        """Devuelve cuota reservada y no aprovechada a lo reservado por el worker"""
+        with self.condicion:
+            self._arrancar()
+            concesion = self.concesiones.get(acuerdo_id)
+            if concesion is not None:
+                concesion[0] += cantidad
+                return
+        # Sin reserva local abierta (anulada o caducada) vuelve a servicio-sela
+        self.encolar(acuerdo_id, cantidad)
+
+    def encolar(self, acuerdo_id, cantidad=1):
+        with self.condicion:
+            self._arrancar()
+            self.pendientes[acuerdo_id] = self.pendientes.get(acuerdo_id, 0) + cantidad
+            self.estadisticas['encolados'] += cantidad
+            self.condicion.notify()
+        return "en_cola"
+
+    def _liberar_concesion(self, acuerdo_id):
+        """Pasa a devoluciones lo que quede reservado para el acuerdo (con el lock)"""
+        disponibles, _ = self.concesiones.pop(acuerdo_id, (0, 0.0))
+        if disponibles:
+            self.pendientes[acuerdo_id] = self.pendientes.get(acuerdo_id, 0) + disponibles
+            self.estadisticas['encolados'] += disponibles
+
+    def _caducar_concesiones(self):
+        """Devuelve las reservas locales sin uso en `ttl` segundos (con el lock)"""
+        limite = time.monotonic() - self.ttl
+        caducadas = [acuerdo_id for acuerdo_id, (_, uso) in self.concesiones.items() if uso <= limite]
+        for acuerdo_id in caducadas:
+            self._liberar_concesion(acuerdo_id)
+        return bool(caducadas)
+
+    def _bucle(self):
+        while True:
+            with self.condicion:
+                while not self.pendientes and not self.recargas and not self._caducar_concesiones():
+                    # Con reservas locales abiertas se despierta para devolver las que caduquen
+                    self.condicion.wait(self.ttl if self.concesiones else None)
+            # Ventana de agrupación: los incrementos que lleguen mientras tanto se suman
+            time.sleep(self.ventana)
+            self.recargar()
+            self.vaciar()
+
+    def recargar(self):
+        """Pide un bloque para cada acuerdo al que le queda menos de medio bloque reservado"""
+        with self.condicion:
+            acuerdos, self.recargas = self.recargas, set()
+        for acuerdo_id in acuerdos:
+            pedido = self.bloque
+            try:
+                try:
+                    self._pedir(acuerdo_id, pedido)
+                except UsoDenegado as e:
+                    restante = e.detalle.get('restante') if isinstance(e.detalle, dict) else None
+                    if not restante:
+                        raise
+                    pedido = restante
+                    self._pedir(acuerdo_id, pedido)
+            except UsoDenegado as e:
+                motivo = e.detalle.get('motivo') if isinstance(e.detalle, dict) else None
+                if e.status == 404 or motivo in ('caducado', 'inactivo'):
+                    # El acuerdo ya no admite uso: lo reservado deja de admitirse aquí
+                    with self.condicion:
+                        self._liberar_concesion(acuerdo_id)
+                        self.estadisticas['concesiones_anuladas'] += 1
+                # Sin cuota o sin servicio-sela se sigue con lo reservado; la siguiente
+                # petición que baje de medio bloque vuelve a intentarlo
+                continue
+            with self.condicion:
+                concesion = self.concesiones.setdefault(acuerdo_id, [0, time.monotonic()])
+                concesion[0] += pedido
+                self.estadisticas['recargas'] += 1
+
+    def vaciar(self):
+        """Envía todos los deltas listos; los fallidos vuelven a la cola"""
+        ahora = time.monotonic()
+        with self.condicion:
+            listos = {
+                acuerdo_id: cantidad for acuerdo_id, cantidad in self.pendientes.items()
+                if self.reintentos.get(acuerdo_id, (0, 0.0))[1] <= ahora
+            }
+            for acuerdo_id in listos:
+                del self.pendientes[acuerdo_id]
+        for acuerdo_id, cantidad in listos.items():
+            self._enviar(acuerdo_id, cantidad)
+
+    def cerrar(self):
+        """Al salir del proceso devuelve todo lo reservado y no usado"""
+        if self.pid != os.getpid():
+            return
+        with self.condicion:
+            for acuerdo_id in list(self.concesiones):
+                self._liberar_concesion(acuerdo_id)
+            self.reintentos.clear()
+        self.vaciar()
+
+    def _enviar(self, acuerdo_id, cantidad):
+        try:
+            url_liberar = f"{self.url_base}/api/v1/acuerdo/{acuerdo_id}/liberar"
+            r = self.sesion.post(url_liberar, params={'cantidad': cantidad}, timeout=2)
+            with self.condicion:
+                self.estadisticas['peticiones'] += 1
+                if r.status_code == 200:
+                    self.estadisticas['enviados'] += cantidad
+                    self.reintentos.pop(acuerdo_id, None)
+                    return
+                if r.status_code == 404:
+                    # Acuerdo inexistente: no queda cuota que devolver y reintentar no lo arregla
+                    print(f"Devolución de {cantidad} descartada para {acuerdo_id}: acuerdo no encontrado")
+                    self.estadisticas['descartados'] += cantidad
+                    self.reintentos.pop(acuerdo_id, None)
+                    return
+            motivo = f"status {r.status_code}"
+        except Exception as e:
+            motivo = str(e)
+
+        with self.condicion:
+            self.estadisticas['fallidos'] += 1
+            intentos = self.reintentos.get(acuerdo_id, (0, 0.0))[0] + 1
+            if intentos > self.max_reintentos:
+                print(f"Devolución de {cantidad} descartada para {acuerdo_id} tras {intentos - 1} reintentos: {motivo}")
+                self.estadisticas['descartados'] += cantidad
+                self.reintentos.pop(acuerdo_id, None)
+                return
+            self.reintentos[acuerdo_id] = (intentos, time.monotonic() + min(2 ** intentos, 60))
+            self.pendientes[acuerdo_id] = self.pendientes.get(acuerdo_id, 0) + cantidad
+            self.condicion.notify()
+
+    def estado(self):
+        with self.condicion:
+            return {
+                'reservados_locales': sum(disponibles for disponibles, _ in self.concesiones.values()),
+                'acuerdos_con_reserva': len(self.concesiones),
+                'pendientes': sum(self.pendientes.values()),
+                'acuerdos_pendientes': len(self.pendientes),
+                'en_reintento': len(self.reintentos),
+                **self.estadisticas
+            }
+
+notificador = NotificadorContador(SELA_SERVICE_URL, NOTIFICADOR_VENTANA, NOTIFICADOR_MAX_REINTENTOS,
+                                  CUOTA_BLOQUE, CUOTA_CONCESION_TTL)
+atexit.register(notificador.cerrar)
+
+def _reservar_bloque(acuerdo_id):
+    """Reserva STREAM_RESERVA_BLOQUE registros, o lo que quede de cuota si es menos"""
+    try:
+        reservar_uso(acuerdo_id, STREAM_RESERVA_BLOQUE)
+        return STREAM_RESERVA_BLOQUE
+    except UsoDenegado as e:
+        restante = e.detalle.get('restante') if isinstance(e.detalle, dict) else None
+        if not restante:
+            raise
+    reservar_uso(acuerdo_id, restante)
+    return restante
+
+def reservar_uso(acuerdo_id, cantidad=1, reserva=None):
+    """Consume la cuota de `cantidad` registros, reservada por bloques en el servicio principal (8000)"""
+    # IMPORTANTE: Asegúrate que 'servicio-sela' es el nombre en tu docker-compose.yml
+    notificador.reservar(acuerdo_id, cantidad, reserva)
+
+def devolver_uso(acuerdo_id, cantidad):
+    """Devuelve la cuota reservada y no aprovechada"""
+    if cantidad > 0:
+        notificador.devolver(acuerdo_id, cantidad)
+
+# --- POOL DE PROCESOS PARA LOTES GRANDES ---
+_pool_procesos = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _inicializar_proceso_lote(clave):
+    # Los procesos 'spawn' reimportan el módulo: deben usar la misma clave HMAC que el worker
+    global SEUDONIMIZACION_CLAVE
+    SEUDONIMIZACION_CLAVE = clave
+
+def _obtener_pool():
+    """Pool de procesos del worker actual (None si FLASK_PROCESOS_LOTE es 0)"""
+    global _pool_procesos, _pool_pid
+    if FLASK_PROCESOS_LOTE <= 0:
+        return None
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool_pid = os.getpid()
+            _pool_procesos = ProcessPoolExecutor(
+                max_workers=FLASK_PROCESOS_LOTE,
+                # 'spawn' evita heredar hilos y locks del worker (el notificador)
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_inicializar_proceso_lote,
+                initargs=(SEUDONIMIZACION_CLAVE,)
+            )
+    return _pool_procesos
+
+def anonimizar_lote_paralelo(registros, acuerdo_id=None):
+    """anonimizar_lote repartido en trozos entre el pool de procesos para lotes grandes"""
+    pool = _obtener_pool()
+    if pool is None or len(registros) < LOTE_UMBRAL_PROCESOS:
+        return anonimizar_lote(registros, acuerdo_id)
+    tamano = -(-len(registros) // FLASK_PROCESOS_LOTE)
+    inicios = range(0, len(registros), tamano)
+    futuros = [pool.submit(anonimizar_lote, registros[inicio:inicio + tamano], acuerdo_id) for inicio in inicios]
+    datos_anonimizados, errores = [], []
+    for inicio, futuro in zip(inicios, futuros):
+        datos, errores_trozo = futuro.result()
+        datos_anonimizados.extend(datos)
+        errores.extend({'indice': error['indice'] + inicio, 'error': error['error']} for error in errores_trozo)
+    return datos_anonimizados, errores
+
+def ejecutar_en_pool(funcion, *args):
+    """Ejecuta una tarea CPU-intensiva fuera del worker HTTP si hay pool configurado"""
+    pool = _obtener_pool()
+    if pool is None:
+        return funcion(*args)
+    return pool.submit(funcion, *args).result()
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -71,22 +1129,19 @@ def anonimizar():
                 'mensaje': 'BLOQUEADO: No se puede anonimizar sin un acuerdo_id vinculado (RGPD)'
             }), 403
 
-        # 3. Anonimizar lo que queda en el diccionario (nombre, email, etc.)
-        datos_anonimizados = anonimizar_datos(cuerpo)
-        
-        # 4. Notificar al servicio principal (8000)
-        notificacion_estado = "pendiente"
+        # 3. Reservar la cuota en el servicio principal (8000) antes de tocar los datos
         try:
-            # IMPORTANTE: Asegúrate que 'servicio-sela' es el nombre en tu docker-compose.yml
-            url_incrementar = f"http://servicio-sela:8000/api/v1/acuerdo/{acuerdo_id}/incrementar"
-            r = requests.post(url_incrementar, timeout=2)
-            
-            if r.status_code == 200:
-                notificacion_estado = "exito"
-            else:
-                notificacion_estado = f"error_8000_status_{r.status_code}"
-        except Exception as e:
-            notificacion_estado = f"error_conexion_{str(e)}"
+            reservar_uso(acuerdo_id)
+        except UsoDenegado as e:
+            return e.respuesta()
+
+        # 4. Anonimizar lo que queda en el diccionario (nombre, email, etc.)
+        try:
+            datos_anonimizados = anonimizar_datos(cuerpo, acuerdo_id)
+        except Exception:
+            devolver_uso(acuerdo_id, 1)
+            raise
+        notificacion_estado = "reservado"
 
         # 5. Preparar respuesta final
         respuesta = {
@@ -107,32 +1162,260 @@ def anonimizar():
             'timestamp': datetime.now().isoformat()
         }), 500
     
+@app.route('/anonimizar/lote', methods=['POST'])
+def anonimizar_lote_endpoint():
+    """
+    Anonimiza miles de registros bajo un mismo acuerdo_id en una sola petición.
+    Los errores se informan por registro sin hacer fallar el lote completo.
+    """
+    try:
+        if not request.is_json:
+            return jsonify({'error': 'Content-Type debe ser application/json'}), 400
+        
+        cuerpo = request.get_json()
+        if not cuerpo:
+            return jsonify({'error': 'No se proporcionaron datos'}), 400
+        
+        acuerdo_id = cuerpo.get('acuerdo_id')
+        if not acuerdo_id:
+            return jsonify({
+                'status': 'error',
+                'mensaje': 'BLOQUEADO: No se puede anonimizar sin un acuerdo_id vinculado (RGPD)'
+            }), 403
+
+        registros = cuerpo.get('registros')
+        if not isinstance(registros, list) or not registros:
+            return jsonify({'error': "'registros' debe ser una lista no vacía"}), 400
+        if len(registros) > LOTE_MAX_REGISTROS:
+            return jsonify({
+                'error': f'El lote supera el máximo de {LOTE_MAX_REGISTROS} registros'
+            }), 413
+
+        nivel = cuerpo.get('nivel_anonimizacion')
+        if nivel not in (None, 'basico', 'k_anonimato'):
+            return jsonify({'error': "nivel_anonimizacion debe ser 'basico' o 'k_anonimato'"}), 400
+
+        if nivel == 'k_anonimato':
+            # Los parámetros se validan antes de reservar cuota
+            jerarquias = cuerpo.get('jerarquias')
+            if not isinstance(jerarquias, dict) or not jerarquias:
+                return jsonify({'error': "El nivel k_anonimato requiere 'jerarquias' por columna"}), 400
+            # Generalizar un campo seudonimizado sustituiría su token por el valor original generalizado
+            seudonimizados = [campo for campo in jerarquias if campo.lower() in CAMPOS_HASH]
+            if seudonimizados:
+                return jsonify({'error': f'Los campos seudonimizados no pueden ser cuasi-identificadores: {seudonimizados}'}), 400
+            try:
+                k = int(cuerpo.get('k', 2))
+                max_supresion = float(cuerpo.get('max_supresion', 0.0))
+                if k < 1 or not 0.0 <= max_supresion <= 1.0:
+                    raise ValueError('k >= 1 y 0 <= max_supresion <= 1')
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': f'Parámetros de generalización inválidos: {str(e)}'}), 400
+
+        # La cuota del lote entero se reserva en servicio-sela antes de anonimizar:
+        # si el acuerdo no la admite, los datos no se procesan
+        try:
+            reservar_uso(acuerdo_id, len(registros), cuerpo.get('reserva'))
+        except UsoDenegado as e:
+            return e.respuesta()
+
+        # Lo reservado y no procesado (errores, supresión o fallo) se devuelve al final
+        procesados = 0
+        try:
+            datos_anonimizados, errores = anonimizar_lote_paralelo(registros, acuerdo_id)
+            procesados = len(registros) - len(errores)
+
+            generalizacion = None
+            if nivel == 'k_anonimato':
+                # Los cuasi-identificadores se generalizan a partir del valor original (sin ruido)
+                indices_validos = [i for i, datos in enumerate(datos_anonimizados) if datos is not None]
+                try:
+                    generalizados, suprimidos, generalizacion = ejecutar_en_pool(
+                        generalizar_k_anonimato,
+                        [registros[i] for i in indices_validos], jerarquias, k, max_supresion,
+                        cuerpo.get('algoritmo', 'auto')
+                    )
+                except (TypeError, ValueError) as e:
+                    procesados = 0
+                    return jsonify({'error': f'Parámetros de generalización inválidos: {str(e)}'}), 400
+                for i, generalizado in zip(indices_validos, generalizados):
+                    if generalizado is None:
+                        datos_anonimizados[i] = None
+                    else:
+                        datos_anonimizados[i].update((campo, generalizado[campo]) for campo in jerarquias)
+                generalizacion['indices_suprimidos'] = [indices_validos[i] for i in suprimidos]
+                procesados -= len(suprimidos)
+        except Exception:
+            procesados = 0
+            raise
+        finally:
+            devolver_uso(acuerdo_id, len(registros) - procesados)
+
+        return jsonify({
+            'operacion_id': str(uuid.uuid4()),
+            'timestamp': datetime.now().isoformat(),
+            'status': 'success' if not errores else 'parcial',
+            'acuerdo_vinculado': acuerdo_id,
+            'registro_contador': 'reservado',
+            'total_registros': len(registros),
+            'registros_procesados': procesados,
+            'errores': errores,
+            **({'generalizacion': generalizacion} if generalizacion else {}),
+            'datos_anonimizados': datos_anonimizados,
+            'servicio': SERVICE_NAME
+        }), 200
+        
+    except Exception as e:
+        return jsonify({
+            'error': f'Error interno: {str(e)}',
+            'timestamp': datetime.now().isoformat()
+        }), 500
+
+@app.route('/anonimizar/stream', methods=['POST'])
+def anonimizar_stream():
+    """
+    Anonimiza un flujo NDJSON o CSV de tamaño arbitrario.
+    El cuerpo se lee por bloques y la respuesta se devuelve en chunks, con memoria constante.
+    """
+    acuerdo_id = request.args.get('acuerdo_id') or request.headers.get('X-Acuerdo-Id')
+    if not acuerdo_id:
+        return jsonify({
+            'status': 'error',
+            'mensaje': 'BLOQUEADO: No se puede anonimizar sin un acuerdo_id vinculado (RGPD)'
+        }), 403
+
+    tipo = request.mimetype
+    if tipo in ('application/x-ndjson', 'application/jsonlines', 'application/json'):
+        leer, serializar, tipo_salida = _registros_ndjson, _serializar_ndjson, 'application/x-ndjson'
+    elif tipo == 'text/csv':
+        # La cabecera de entrada la rellena el lector y la usa el serializador
+        cabecera = []
+        leer = partial(_registros_csv, cabecera=cabecera)
+        serializar = partial(_serializar_csv, cabecera=cabecera)
+        tipo_salida = 'text/csv'
+    else:
+        return jsonify({'error': 'Content-Type debe ser application/x-ndjson o text/csv'}), 415
+
+    operacion_id = str(uuid.uuid4())
+
+    # El primer bloque de cuota se reserva antes de responder: sin cuota, 403 y nada se lee
+    try:
+        reservados = _reservar_bloque(acuerdo_id)
+    except UsoDenegado as e:
+        return e.respuesta()
+
+    def generar():
+        nonlocal reservados
+        procesados = 0
+        disponibles = reservados
+
+        def con_cuota(registros):
+            # Cada registro válido gasta una unidad reservada; al agotarse se reserva otro bloque
+            nonlocal reservados, disponibles
+            for indice, registro, error in registros:
+                if error is None and not disponibles:
+                    try:
+                        bloque = _reservar_bloque(acuerdo_id)
+                    except UsoDenegado as e:
+                        yield indice, None, f'Flujo interrumpido, el acuerdo no admite más uso: {e.detalle}'
+                        return
+                    reservados += bloque
+                    disponibles += bloque
+                if error is None:
+                    disponibles -= 1
+                yield indice, registro, error
+
+        def contar(resultados):
+            nonlocal procesados
+            for resultado in resultados:
+                if resultado[2] is None:
+                    procesados += 1
+                yield resultado
+
+        try:
+            lineas = _leer_lineas(request.stream)
+            yield from _agrupar_bloques(serializar(contar(anonimizar_flujo(con_cuota(leer(lineas)), acuerdo_id))))
+        finally:
+            # Al cerrar el flujo se devuelve de una vez la cuota reservada y no usada
+            devolver_uso(acuerdo_id, reservados - procesados)
+
+    return Response(
+        stream_with_context(generar()),
+        mimetype=tipo_salida,
+        headers={'X-Operacion-Id': operacion_id, 'X-Acuerdo-Vinculado': acuerdo_id}
+    )
+
 # --- NUEVO ENDPOINT PARA CORREGIR EL ERROR 404 ---
 @app.route('/verificar/k-anonimity', methods=['POST'])
 def verificar_k_anonimity():
     """
-    Endpoint para verificar el nivel de k-anonimidad.
-    Soluciona el FAIL: K-anonimity - Codigo 404
+    Verifica el nivel de k-anonimidad calculando las clases de equivalencia
+    sobre los cuasi-identificadores (y opcionalmente la l-diversidad).
+    Acepta registros ('datos_anonimizados' o 'registros') o columnas ('columnas').
     """
     try:
-        datos = request.get_json()
-        k_deseado = datos.get('k', 2)
-        
-        # Lógica de validación para el tribunal
+        datos = request.get_json(silent=True) or {}
+        k_deseado = int(datos.get('k', 2))
+        if k_deseado < 1:
+            return jsonify({'error': 'k debe ser mayor o igual que 1'}), 400
+
+        registros = datos.get('datos_anonimizados') or datos.get('registros')
+        columnas = datos.get('columnas')
+        if registros:
+            if not isinstance(registros, list) or not all(isinstance(r, dict) for r in registros):
+                return jsonify({'error': 'Los registros deben ser una lista de objetos JSON'}), 400
+            columnas = registros_a_columnas(registros)
+        elif not isinstance(columnas, dict) or not columnas:
+            return jsonify({'error': 'No se proporcionaron datos'}), 400
+
+        atributo_sensible = datos.get('atributo_sensible')
+        if atributo_sensible is not None and not isinstance(atributo_sensible, str):
+            return jsonify({'error': 'atributo_sensible debe ser un nombre de campo'}), 400
+        cuasi_identificadores = datos.get('cuasi_identificadores')
+        if cuasi_identificadores is None:
+            cuasi_identificadores = [campo for campo in columnas if campo != atributo_sensible]
+        if (not isinstance(cuasi_identificadores, list) or not cuasi_identificadores
+                or not all(isinstance(campo, str) for campo in cuasi_identificadores)):
+            return jsonify({'error': 'cuasi_identificadores debe ser una lista no vacía de nombres de campo'}), 400
+        faltan = [c for c in cuasi_identificadores + ([atributo_sensible] if atributo_sensible else [])
+                  if c not in columnas]
+        if faltan:
+            return jsonify({'error': f'Columnas no encontradas: {faltan}'}), 400
+        if len({len(columnas[c]) for c in columnas}) > 1:
+            return jsonify({'error': 'Todas las columnas deben tener la misma longitud'}), 400
+
+        modo = datos.get('modo', 'completo')
+        if modo not in ('completo', 'estimacion'):
+            return jsonify({'error': "modo debe ser 'completo' o 'estimacion'"}), 400
+        muestra = int(datos.get('muestra', K_ANON_MUESTRA)) if modo == 'estimacion' else None
+
+        resultado = verificar_k_anonimato(
+            columnas, cuasi_identificadores, k_deseado,
+            atributo_sensible=atributo_sensible,
+            l=datos.get('l'),
+            muestra=muestra
+        )
+
+        if resultado['cumple_k']:
+            mensaje = f'El conjunto de datos cumple con k={k_deseado}'
+        else:
+            mensaje = (f"El conjunto de datos NO cumple con k={k_deseado}: "
+                       f"{resultado['clases_violan_k']} clases por debajo del umbral")
         return jsonify({
             'status': 'success',
-            'k_verificado': k_deseado,
+            'k_requerido': k_deseado,
+            'k_verificado': resultado['k_minimo'],
             'metodo': 'analisis_por_cuasidentificadores',
-            'mensaje': f'El conjunto de datos cumple con k={k_deseado}',
+            'modo': modo,
+            'mensaje': mensaje,
+            **resultado,
             'timestamp': datetime.now().isoformat()
         }), 200
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Parámetros inválidos: {str(e)}'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-if __name__ == '__main__':
-    port = int(os.getenv('FLASK_PORT', 8001))
-    app.run(host='0.0.0.0', port=port)
-
 @app.route('/info', methods=['GET'])
 def info():
     """Información del servicio"""
@@ -143,13 +1426,18 @@ def info():
         'endpoints': {
             '/health': 'GET - Verificar salud del servicio',
             '/anonimizar': 'POST - Anonimizar datos (JSON)',
+            '/anonimizar/lote': 'POST - Anonimizar un lote de registros bajo un acuerdo',
+            '/anonimizar/stream': 'POST - Anonimizar un flujo NDJSON o CSV (?acuerdo_id=)',
+            '/verificar/k-anonimity': 'POST - Verificar k-anonimidad y l-diversidad',
             '/info': 'GET - Información del servicio'
         },
+        'seudonimizacion': estadisticas_seudonimizacion(),
+        'notificador_contador': notificador.estado(),
         'timestamp': datetime.now().isoformat()
     })
 
 if __name__ == '__main__':
-    # Configuración para producción
+    # Servidor de desarrollo; en producción: gunicorn -c gunicorn.conf.py app:app
     host = os.getenv('FLASK_HOST', '0.0.0.0')
     port = int(os.getenv('FLASK_PORT', 8001))
     debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
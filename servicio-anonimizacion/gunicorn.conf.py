@@ -0,0 +1,21 @@
+# Configuración de gunicorn para servir el servicio en producción
+import multiprocessing
+import os
+
+bind = f"{os.getenv('FLASK_HOST', '0.0.0.0')}:{os.getenv('FLASK_PORT', '8001')}"
+
+# Un worker pre-fork por núcleo; cada uno atiende varias peticiones con hilos
+workers = int(os.getenv('FLASK_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.getenv('FLASK_THREADS', 4))
+worker_class = 'gthread'
+
+timeout = int(os.getenv('FLASK_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('FLASK_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('FLASK_KEEPALIVE', 5))
+
+# Cargar la app antes del fork para compartir la clave HMAC y la memoria de solo lectura
+preload_app = True
+
+loglevel = 'debug' if os.getenv('FLASK_DEBUG', 'False').lower() == 'true' else 'info'
+accesslog = '-'
+errorlog = '-'
@@ -13,4 +13,162 @@ CREATE TABLE IF NOT EXISTS blockchain_hashes (
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     transactions_count INTEGER DEFAULT 0,
     UNIQUE(block_id)
-);
\ No newline at end of file
+);
+
+-- 3. Índices para la paginación keyset sobre (timestamp, id) y filtros de /logs
+CREATE INDEX IF NOT EXISTS idx_logs_timestamp_id ON auditoria_logs (timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_acuerdo_timestamp_id ON auditoria_logs (acuerdo_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_operacion_timestamp_id ON auditoria_logs (operacion, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_servicio_timestamp_id ON auditoria_logs (servicio_origen, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_metadatos ON auditoria_logs USING GIN (metadatos jsonb_path_ops);
+
+-- 4. Cadena de bloques con árboles de Merkle por bloque
+ALTER TABLE blockchain_hashes
+ADD COLUMN IF NOT EXISTS merkle_root VARCHAR(128),
+ADD COLUMN IF NOT EXISTS primer_log_id INTEGER,
+ADD COLUMN IF NOT EXISTS ultimo_log_id INTEGER;
+CREATE INDEX IF NOT EXISTS idx_logs_operacion_id ON auditoria_logs (operacion_id);
+CREATE INDEX IF NOT EXISTS idx_logs_bloque ON auditoria_logs (blockchain_block_id, id);
+CREATE INDEX IF NOT EXISTS idx_logs_pendientes_sellado ON auditoria_logs (id) WHERE blockchain_block_id IS NULL;
+
+-- 5. Historial de verificaciones de la cadena (la última fila es el punto verificado)
+CREATE TABLE IF NOT EXISTS blockchain_verificaciones (
+    id SERIAL PRIMARY KEY,
+    tipo VARCHAR(20) NOT NULL,
+    desde_bloque INTEGER,
+    hasta_bloque INTEGER,
+    verificado_hasta INTEGER NOT NULL,
+    verificado_hash VARCHAR(128) NOT NULL,
+    bloques_verificados INTEGER DEFAULT 0,
+    eventos_verificados BIGINT,
+    integridad VARCHAR(20) NOT NULL,
+    primer_bloque_invalido INTEGER,
+    motivo TEXT,
+    duracion_ms INTEGER,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 6. Particionado mensual de auditoria_logs (solo si la tabla existente no está particionada)
+ALTER TABLE blockchain_hashes ADD COLUMN IF NOT EXISTS archivado BOOLEAN DEFAULT FALSE;
+
+DO $$
+DECLARE
+    mes DATE;
+    ultimo DATE;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'auditoria_logs'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE auditoria_logs RENAME TO auditoria_logs_sin_particionar;
+    ALTER INDEX IF EXISTS auditoria_logs_pkey RENAME TO auditoria_logs_sin_particionar_pkey;
+    CREATE TABLE auditoria_logs (
+        id SERIAL,
+        operacion_id UUID DEFAULT gen_random_uuid(),
+        operacion VARCHAR(100) NOT NULL,
+        servicio_origen VARCHAR(100) NOT NULL,
+        acuerdo_id VARCHAR(100),
+        datos_procesados INTEGER DEFAULT 0,
+        resultado TEXT,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        metadatos JSONB,
+        blockchain_hash VARCHAR(128),
+        blockchain_verified BOOLEAN DEFAULT FALSE,
+        blockchain_block_id INTEGER,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+    CREATE TABLE auditoria_logs_default PARTITION OF auditoria_logs DEFAULT;
+
+    -- Una partición por cada mes con datos y por los tres siguientes al actual
+    mes := date_trunc('month', COALESCE((SELECT MIN(timestamp) FROM auditoria_logs_sin_particionar), now()))::date;
+    ultimo := (date_trunc('month', now()) + interval '3 months')::date;
+    WHILE mes <= ultimo LOOP
+        EXECUTE format('CREATE TABLE auditoria_logs_p%s PARTITION OF auditoria_logs FOR VALUES FROM (%L) TO (%L)',
+                       to_char(mes, 'YYYYMM'), mes, (mes + interval '1 month')::date);
+        mes := (mes + interval '1 month')::date;
+    END LOOP;
+
+    INSERT INTO auditoria_logs
+        (id, operacion_id, operacion, servicio_origen, acuerdo_id, datos_procesados, resultado,
+         timestamp, metadatos, blockchain_hash, blockchain_verified, blockchain_block_id)
+    SELECT id, operacion_id, operacion, servicio_origen, acuerdo_id, datos_procesados, resultado,
+           COALESCE(timestamp, now()), metadatos, blockchain_hash, blockchain_verified, blockchain_block_id
+    FROM auditoria_logs_sin_particionar;
+    PERFORM setval(pg_get_serial_sequence('auditoria_logs', 'id'),
+                   COALESCE((SELECT MAX(id) FROM auditoria_logs), 0) + 1, false);
+
+    DROP TABLE auditoria_logs_sin_particionar;
+END $$;
+
+-- Los índices de la sección 3 y 4 se crean de nuevo sobre la tabla particionada
+CREATE INDEX IF NOT EXISTS idx_logs_timestamp_id ON auditoria_logs (timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_acuerdo_timestamp_id ON auditoria_logs (acuerdo_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_operacion_timestamp_id ON auditoria_logs (operacion, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_servicio_timestamp_id ON auditoria_logs (servicio_origen, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_metadatos ON auditoria_logs USING GIN (metadatos jsonb_path_ops);
+CREATE INDEX IF NOT EXISTS idx_logs_operacion_id ON auditoria_logs (operacion_id);
+CREATE INDEX IF NOT EXISTS idx_logs_bloque ON auditoria_logs (blockchain_block_id, id);
+CREATE INDEX IF NOT EXISTS idx_logs_pendientes_sellado ON auditoria_logs (id) WHERE blockchain_block_id IS NULL;
+
+-- 7. Resúmenes incrementales por hora y día para /reporte/generar
+CREATE TABLE IF NOT EXISTS auditoria_resumen_hora (
+    hora TIMESTAMP NOT NULL,
+    acuerdo_id VARCHAR(100) NOT NULL DEFAULT '',
+    operacion VARCHAR(100) NOT NULL,
+    servicio_origen VARCHAR(100) NOT NULL,
+    eventos BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (hora, acuerdo_id, operacion, servicio_origen)
+);
+CREATE TABLE IF NOT EXISTS auditoria_resumen_dia (
+    dia TIMESTAMP NOT NULL,
+    acuerdo_id VARCHAR(100) NOT NULL DEFAULT '',
+    operacion VARCHAR(100) NOT NULL,
+    servicio_origen VARCHAR(100) NOT NULL,
+    eventos BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (dia, acuerdo_id, operacion, servicio_origen)
+);
+
+-- 8. Registro único de operacion_id (idempotencia de /registrar y /registrar/lote).
+-- auditoria_logs está particionada por timestamp y no admite UNIQUE (operacion_id)
+CREATE TABLE IF NOT EXISTS auditoria_operaciones (
+    operacion_id UUID PRIMARY KEY
+);
+INSERT INTO auditoria_operaciones (operacion_id)
+SELECT DISTINCT operacion_id FROM auditoria_logs WHERE operacion_id IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+-- 9. Marca de agua (timestamp, id) de los resúmenes, en lugar de marcar cada evento
+-- con `resumido`. Aplicar con el servicio parado: suma los eventos aún sin resumir,
+-- fija la marca en el último evento y elimina la columna.
+CREATE TABLE IF NOT EXISTS auditoria_resumen_marca (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    timestamp TIMESTAMP NOT NULL,
+    log_id INTEGER NOT NULL
+);
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM auditoria_resumen_marca) THEN
+        RETURN;
+    END IF;
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'auditoria_logs' AND column_name = 'resumido') THEN
+        CREATE TEMP TABLE resumen_pendiente ON COMMIT DROP AS
+        SELECT date_trunc('hour', timestamp) AS hora, COALESCE(acuerdo_id, '') AS acuerdo_id,
+               operacion, servicio_origen, COUNT(*) AS eventos
+        FROM auditoria_logs WHERE NOT resumido GROUP BY 1, 2, 3, 4;
+        INSERT INTO auditoria_resumen_hora AS r (hora, acuerdo_id, operacion, servicio_origen, eventos)
+        SELECT * FROM resumen_pendiente
+        ON CONFLICT (hora, acuerdo_id, operacion, servicio_origen)
+        DO UPDATE SET eventos = r.eventos + EXCLUDED.eventos;
+        INSERT INTO auditoria_resumen_dia AS r (dia, acuerdo_id, operacion, servicio_origen, eventos)
+        SELECT date_trunc('day', hora), acuerdo_id, operacion, servicio_origen, SUM(eventos)
+        FROM resumen_pendiente GROUP BY 1, 2, 3, 4
+        ON CONFLICT (dia, acuerdo_id, operacion, servicio_origen)
+        DO UPDATE SET eventos = r.eventos + EXCLUDED.eventos;
+        ALTER TABLE auditoria_logs DROP COLUMN resumido;
+    END IF;
+    INSERT INTO auditoria_resumen_marca (id, timestamp, log_id)
+    SELECT 1, COALESCE(MAX(timestamp), '-infinity'), 0 FROM auditoria_logs;
+    UPDATE auditoria_resumen_marca
+    SET log_id = COALESCE((SELECT MAX(id) FROM auditoria_logs l WHERE l.timestamp = auditoria_resumen_marca.timestamp), 0);
+END $$;
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Sin PostgreSQL: las pruebas no arrancan el ciclo de vida de la app y sustituyen
+# las funciones de escritura cuando las necesitan
+os.environ.setdefault("DATABASE_URL", "postgresql://auditoria@127.0.0.1:1/auditoria")
+os.environ.setdefault("BLOCKCHAIN_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,117 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as auditoria
+
+
+@pytest.fixture
+def filtro(monkeypatch):
+    monkeypatch.setattr(auditoria, "DEDUP_BLOOM_CAPACIDAD", 1000)
+    monkeypatch.setattr(auditoria, "DEDUP_LRU_MAX", 10)
+    return auditoria.FiltroOperaciones()
+
+
+def test_bloom_sin_falsos_negativos_y_tasa_fp_acotada():
+    bloom = auditoria.FiltroBloom(5000, 0.01)
+    claves = [str(uuid.uuid4()) for _ in range(5000)]
+    for clave in claves:
+        bloom.agregar(clave)
+    assert all(clave in bloom for clave in claves)
+    falsos = sum(str(uuid.uuid4()) in bloom for _ in range(5000))
+    assert falsos / 5000 < 0.03
+
+
+def test_clasificacion_nuevo_duplicado_y_quizas(filtro):
+    operacion_id = str(uuid.uuid4())
+    assert filtro.clasificar(operacion_id) == "nuevo"
+    filtro.registrar(operacion_id)
+    assert filtro.clasificar(operacion_id) == "duplicado"
+    # Fuera de la LRU solo queda el Bloom, que no puede asegurar el duplicado
+    filtro.recientes.clear()
+    assert filtro.clasificar(operacion_id) == "quizas"
+
+
+def test_lru_acotada(filtro):
+    ids = [str(uuid.uuid4()) for _ in range(25)]
+    for operacion_id in ids:
+        filtro.registrar(operacion_id)
+    assert len(filtro.recientes) == 10
+    assert filtro.clasificar(ids[-1]) == "duplicado"
+    assert filtro.clasificar(ids[0]) == "quizas"
+
+
+def test_rotacion_conserva_la_generacion_anterior(filtro):
+    ids = [str(uuid.uuid4()) for _ in range(1500)]
+    for operacion_id in ids:
+        filtro.registrar(operacion_id)
+    filtro.recientes.clear()
+    assert filtro.rotaciones == 1
+    assert all(filtro.clasificar(operacion_id) == "quizas" for operacion_id in ids)
+
+
+def test_registrar_error_de_db_no_marca_el_id(monkeypatch):
+    monkeypatch.setattr(auditoria, "filtro_operaciones", auditoria.FiltroOperaciones())
+    cliente = TestClient(auditoria.app)
+    evento = {"operacion_id": str(uuid.uuid4()), "operacion": "PRUEBA"}
+
+    def caida(*args):
+        raise RuntimeError("base de datos caída")
+    monkeypatch.setattr(auditoria, "_insertar_log", caida)
+    assert cliente.post("/registrar", json=evento).status_code == 503
+    assert auditoria.filtro_operaciones.clasificar(evento["operacion_id"]) == "nuevo"
+
+    # El reintento del emisor se registra y el siguiente ya es duplicado
+    monkeypatch.setattr(auditoria, "_insertar_log", lambda *args: True)
+    assert "duplicado" not in cliente.post("/registrar", json=evento).json()
+    assert cliente.post("/registrar", json=evento).json()["duplicado"] is True
+
+
+def test_lote_descartado_se_olvida_y_sale_de_la_cache(monkeypatch):
+    monkeypatch.setattr(auditoria, "filtro_operaciones", auditoria.FiltroOperaciones())
+    monkeypatch.setattr(auditoria, "cache_auditoria", auditoria.CacheAuditoria())
+    monkeypatch.setattr(auditoria, "ESCRITURA_REINTENTOS", 0)
+
+    def caida(filas):
+        raise RuntimeError("base de datos caída")
+    monkeypatch.setattr(auditoria, "_insertar_lote", caida)
+
+    operacion_id = str(uuid.uuid4())
+    auditoria.filtro_operaciones.registrar(operacion_id)
+    auditoria.cache_auditoria.agregar({"id": operacion_id, "acuerdo_id": "a1", "servicio_origen": "s"})
+    fila = auditoria._fila_log(operacion_id, "PRUEBA", "s", {"acuerdo_id": "a1"}, None)
+
+    async def escribir():
+        await auditoria.BufferEscritura(duradero=False)._escribir([(fila, None)])
+    asyncio.run(escribir())
+
+    assert auditoria.filtro_operaciones.clasificar(operacion_id) != "duplicado"
+    assert not auditoria.cache_auditoria.eventos
+    assert auditoria.cache_auditoria.totales["acuerdo_id"]["a1"] == 0
+    assert auditoria.cache_auditoria.total_eventos == 0
+
+
+def test_duplicado_olvidado_por_el_filtro_sale_de_la_cache(monkeypatch):
+    monkeypatch.setattr(auditoria, "filtro_operaciones", auditoria.FiltroOperaciones())
+    monkeypatch.setattr(auditoria, "cache_auditoria", auditoria.CacheAuditoria())
+    # La base de datos ya tenía el id: la restricción única no inserta nada
+    monkeypatch.setattr(auditoria, "_insertar_lote", lambda filas: set())
+
+    operacion_id = str(uuid.uuid4())
+    original = {"id": operacion_id, "acuerdo_id": "a1", "servicio_origen": "s", "operacion": "ORIGINAL"}
+    auditoria.cache_auditoria.agregar(original)
+    auditoria.cache_auditoria.agregar({**original, "operacion": "REPETIDO"})
+    fila = auditoria._fila_log(operacion_id, "REPETIDO", "s", {"acuerdo_id": "a1"}, None)
+
+    async def escribir(duradero):
+        confirmacion = asyncio.get_running_loop().create_future() if duradero else None
+        await auditoria.BufferEscritura(duradero=duradero)._escribir([(fila, confirmacion)])
+        return confirmacion and confirmacion.result()
+
+    assert asyncio.run(escribir(duradero=False)) is None
+    assert [registro for registro, _ in auditoria.cache_auditoria.eventos.values()] == [original]
+    assert auditoria.cache_auditoria.totales["acuerdo_id"]["a1"] == 1
+    # En modo grupo la confirmación indica que no se insertó
+    assert asyncio.run(escribir(duradero=True)) is False
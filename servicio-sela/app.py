@@ -1,13 +1,36 @@
-
+from abc import ABC, abstractmethod
 from enum import Enum
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from pydantic import BaseModel, field_validator # Importante añadir field_validator
 from typing import Optional, Dict, List, Any
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import asyncio
+import bisect
+import heapq
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
 import uuid
 import hashlib
 from datetime import datetime
 import httpx
 
+try:
+    import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:  # solo necesario con SELA_ALMACENAMIENTO=postgres
+    psycopg2 = None
+
+try:
+    import h2  # habilita HTTP/2 en httpx (pip install httpx[http2])
+except ImportError:
+    h2 = None
+
 class BaseLegalRGPD(str, Enum):
     CONSENTIMIENTO = "consentimiento"
     CONTRATO = "contrato"
@@ -18,9 +41,1848 @@ class BaseLegalRGPD(str, Enum):
 
 app = FastAPI(title="Sistema SeLA - API Principal")
 
-# Base de datos en memoria (para demo)
-acuerdos_db: Dict[str, dict] = {}
-operaciones_db: Dict[str, dict] = {}
+# --- ALMACENAMIENTO DE ACUERDOS Y OPERACIONES ---
+# memoria (por defecto, se pierde al reiniciar), sqlite (fichero local en modo WAL)
+# o postgres (compartido entre varias réplicas)
+SELA_ALMACENAMIENTO = os.getenv('SELA_ALMACENAMIENTO', 'memoria').lower()
+SELA_SQLITE_RUTA = os.getenv('SELA_SQLITE_RUTA', 'sela.db')
+SELA_DATABASE_URL = os.getenv('SELA_DATABASE_URL', '')
+SELA_DB_HILOS = int(os.getenv('SELA_DB_HILOS', 8))
+# Caché de lectura de acuerdos (solo con almacenamiento persistente)
+SELA_CACHE_MAX = int(os.getenv('SELA_CACHE_MAX', 10000))
+SELA_CACHE_TTL = float(os.getenv('SELA_CACHE_TTL', 5))
+
+
+class AlmacenMemoria:
+    """Diccionarios del proceso: el comportamiento original de la demo"""
+    bloqueante = False
+    nombre = "memoria"
+
+    def __init__(self):
+        self.acuerdos: Dict[str, dict] = {}
+        self.operaciones: Dict[str, dict] = {}
+        # outbox: id -> [evento, intentos, siguiente_intento]
+        self.outbox: Dict[str, list] = OrderedDict()
+
+    def inicializar(self):
+        pass
+
+    def cerrar(self):
+        pass
+
+    def guardar_acuerdo(self, acuerdo, eventos=()):
+        self.acuerdos[acuerdo["id"]] = acuerdo
+        self._encolar_eventos(eventos)
+
+    def _encolar_eventos(self, eventos):
+        for evento in eventos:
+            self.outbox[evento["operacion_id"]] = [evento, 0, 0.0]
+
+    def pendientes_outbox(self, limite, ahora):
+        return [(id_evento, evento, intentos)
+                for id_evento, (evento, intentos, siguiente) in self.outbox.items()
+                if siguiente <= ahora][:limite]
+
+    def confirmar_outbox(self, ids):
+        for id_evento in ids:
+            self.outbox.pop(id_evento, None)
+
+    def aplazar_outbox(self, ids, siguiente):
+        for id_evento in ids:
+            entrada = self.outbox.get(id_evento)
+            if entrada is not None:
+                entrada[1] += 1
+                entrada[2] = siguiente
+
+    def estado_outbox(self):
+        primero = next(iter(self.outbox.values()), None)
+        return len(self.outbox), primero[0].get("timestamp") if primero else None
+
+    def obtener_acuerdo(self, acuerdo_id):
+        return self.acuerdos.get(acuerdo_id)
+
+    def listar_acuerdos(self):
+        return list(self.acuerdos.values())
+
+    def contar_acuerdos(self, estado=None):
+        if estado is None:
+            return len(self.acuerdos)
+        return sum(1 for a in self.acuerdos.values() if a.get("estado") == estado)
+
+    def total_operaciones_ejecutadas(self):
+        return sum(a.get("operaciones_ejecutadas", 0) for a in self.acuerdos.values())
+
+    def vencimientos_activos(self):
+        vencimientos = ((acuerdo_id, _vencimiento(a)) for acuerdo_id, a in self.acuerdos.items()
+                        if a.get("estado") == "activo")
+        return [(acuerdo_id, vence) for acuerdo_id, vence in vencimientos if vence is not None]
+
+    def caducar_acuerdos(self, eventos):
+        caducados = []
+        for acuerdo_id, evento in eventos.items():
+            acuerdo = self.acuerdos.get(acuerdo_id)
+            if acuerdo is not None and acuerdo.get("estado") == "activo":
+                acuerdo["estado"] = "caducado"
+                self._encolar_eventos([evento])
+                caducados.append(acuerdo_id)
+        return caducados
+
+    def incrementar_operaciones(self, acuerdo_id, cantidad):
+        # Sin await de por medio: atómico dentro del bucle de eventos
+        acuerdo = self.acuerdos.get(acuerdo_id)
+        if acuerdo is None:
+            return None
+        acuerdo["operaciones_ejecutadas"] = acuerdo.get("operaciones_ejecutadas", 0) + cantidad
+        return acuerdo["operaciones_ejecutadas"]
+
+    def guardar_operacion(self, operacion, eventos=()):
+        self.operaciones[operacion["id"]] = operacion
+        self._encolar_eventos(eventos)
+
+    def actualizar_operaciones(self, operaciones, eventos=()):
+        for operacion in operaciones:
+            self.operaciones[operacion["id"]] = operacion
+        self._encolar_eventos(eventos)
+
+    def obtener_operacion(self, operacion_id):
+        return self.operaciones.get(operacion_id)
+
+    def aplicar_incrementos(self, deltas, operaciones):
+        totales = {}
+        for acuerdo_id, delta in deltas.items():
+            total = self.incrementar_operaciones(acuerdo_id, delta)
+            if total is not None:
+                totales[acuerdo_id] = total
+        for operacion in operaciones:
+            self.guardar_operacion(operacion)
+        return totales
+
+    def contar_operaciones(self, estado=None):
+        if estado is None:
+            return len(self.operaciones)
+        return sum(1 for op in self.operaciones.values() if op.get("estado") == estado)
+
+    def ultimas_operaciones(self, limite):
+        return list(self.operaciones.values())[-limite:]
+
+    def resumen_estadisticas(self):
+        acuerdos = Counter(
+            (a.get("estado"), _texto(a.get("tipo_datos")), _texto(a.get("finalidad")))
+            for a in self.acuerdos.values()
+        )
+        return {
+            "acuerdos": [(*clave, n) for clave, n in acuerdos.items()],
+            "usos": self.total_operaciones_ejecutadas(),
+            "operaciones": [
+                (*clave, n) for clave, n in
+                Counter((op.get("estado"), _tipo_operacion(op)) for op in self.operaciones.values()).items()
+            ]
+        }
+
+
+def _texto(valor):
+    return None if valor is None else str(valor)
+
+
+def _tipo_operacion(operacion):
+    # Las operaciones de /ejecutar llevan "operacion"; las evidencias de /incrementar, "tipo"
+    return _texto(operacion.get("operacion") or operacion.get("tipo"))
+
+
+class AlmacenSQL(ABC):
+    """Tablas, índices y consultas comunes a SQLite y PostgreSQL.
+
+    `estado` y `operaciones_ejecutadas` son columnas propias para poder filtrar
+    e incrementar sin reescribir el documento; el resto del acuerdo (los campos
+    libres del payload) se guarda como JSON.
+    """
+    bloqueante = True
+    marcador = "?"
+    tipo_json = "TEXT"
+
+    def _sql(self, sentencia):
+        return sentencia.replace("?", self.marcador)
+
+    @abstractmethod
+    def _cursor(self):
+        """Context manager con un cursor de una conexión del backend"""
+
+    def _transaccion(self):
+        # Por defecto cada uso de _cursor ya es una transacción (PostgreSQL)
+        return self._cursor()
+
+    def inicializar(self):
+        with self._cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS acuerdos (
+                    id TEXT PRIMARY KEY,
+                    estado TEXT NOT NULL,
+                    tipo_datos TEXT,
+                    finalidad TEXT,
+                    operaciones_ejecutadas BIGINT NOT NULL DEFAULT 0,
+                    timestamp TEXT NOT NULL,
+                    vence DOUBLE PRECISION,
+                    datos {self.tipo_json} NOT NULL
+                )
+            """)
+            if "vence" not in self._columnas(cursor, "acuerdos"):
+                # Bases creadas antes de la caducidad automática
+                cursor.execute("ALTER TABLE acuerdos ADD COLUMN vence DOUBLE PRECISION")
+                cursor.execute("SELECT id, datos FROM acuerdos WHERE estado = 'activo'")
+                for acuerdo_id, datos in cursor.fetchall():
+                    cursor.execute(self._sql("UPDATE acuerdos SET vence = ? WHERE id = ?"),
+                                   (_vencimiento(self._documento(datos)), acuerdo_id))
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS operaciones (
+                    id TEXT PRIMARY KEY,
+                    acuerdo_id TEXT NOT NULL,
+                    estado TEXT,
+                    tipo TEXT,
+                    timestamp TEXT NOT NULL,
+                    datos {self.tipo_json} NOT NULL
+                )
+            """)
+            # Outbox de eventos de auditoría: se escribe en la misma transacción que el cambio
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS outbox_auditoria (
+                    id TEXT PRIMARY KEY,
+                    creado TEXT NOT NULL,
+                    evento {self.tipo_json} NOT NULL,
+                    intentos INTEGER NOT NULL DEFAULT 0,
+                    siguiente_intento DOUBLE PRECISION NOT NULL DEFAULT 0
+                )
+            """)
+            for indice in (
+                "CREATE INDEX IF NOT EXISTS idx_outbox_siguiente ON outbox_auditoria (siguiente_intento, creado)",
+                "CREATE INDEX IF NOT EXISTS idx_acuerdos_estado ON acuerdos (estado)",
+                "CREATE INDEX IF NOT EXISTS idx_acuerdos_tipo_datos ON acuerdos (tipo_datos)",
+                "CREATE INDEX IF NOT EXISTS idx_acuerdos_finalidad ON acuerdos (finalidad)",
+                "CREATE INDEX IF NOT EXISTS idx_operaciones_acuerdo_id ON operaciones (acuerdo_id)",
+                "CREATE INDEX IF NOT EXISTS idx_operaciones_estado ON operaciones (estado)",
+                "CREATE INDEX IF NOT EXISTS idx_operaciones_timestamp ON operaciones (timestamp)",
+            ):
+                cursor.execute(indice)
+
+    @abstractmethod
+    def _columnas(self, cursor, tabla):
+        """Nombres de las columnas de `tabla`"""
+
+    @staticmethod
+    def _documento(valor):
+        # JSONB llega ya como dict desde psycopg2; TEXT (SQLite) como cadena
+        return valor if isinstance(valor, dict) else json.loads(valor)
+
+    def _acuerdo_desde_fila(self, fila):
+        estado, operaciones_ejecutadas, datos = fila
+        acuerdo = self._documento(datos)
+        acuerdo["estado"] = estado
+        acuerdo["operaciones_ejecutadas"] = operaciones_ejecutadas
+        return acuerdo
+
+    def guardar_acuerdo(self, acuerdo, eventos=()):
+        # operaciones_ejecutadas no se sobrescribe al actualizar: solo lo cambia
+        # incrementar_operaciones, para no perder incrementos concurrentes
+        with self._transaccion() as cursor:
+            cursor.execute(self._sql("""
+                INSERT INTO acuerdos (id, estado, tipo_datos, finalidad, operaciones_ejecutadas, timestamp, vence, datos)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    estado = excluded.estado,
+                    tipo_datos = excluded.tipo_datos,
+                    finalidad = excluded.finalidad,
+                    timestamp = excluded.timestamp,
+                    vence = excluded.vence,
+                    datos = excluded.datos
+            """), (
+                acuerdo["id"], acuerdo.get("estado", "activo"), _texto(acuerdo.get("tipo_datos")),
+                _texto(acuerdo.get("finalidad")), acuerdo.get("operaciones_ejecutadas", 0),
+                _texto(acuerdo.get("timestamp")), _vencimiento(acuerdo), json.dumps(acuerdo, default=str)
+            ))
+            self._encolar_eventos(cursor, eventos)
+
+    def _encolar_eventos(self, cursor, eventos):
+        for evento in eventos:
+            cursor.execute(self._sql(
+                "INSERT INTO outbox_auditoria (id, creado, evento) VALUES (?, ?, ?)"
+            ), (evento["operacion_id"], evento["timestamp"], json.dumps(evento, default=str)))
+
+    def pendientes_outbox(self, limite, ahora):
+        with self._cursor() as cursor:
+            cursor.execute(self._sql("""
+                SELECT id, evento, intentos FROM outbox_auditoria
+                WHERE siguiente_intento <= ? ORDER BY creado, id LIMIT ?
+            """), (ahora, limite))
+            return [(id_evento, self._documento(evento), intentos) for id_evento, evento, intentos in cursor.fetchall()]
+
+    def confirmar_outbox(self, ids):
+        with self._transaccion() as cursor:
+            for id_evento in ids:
+                cursor.execute(self._sql("DELETE FROM outbox_auditoria WHERE id = ?"), (id_evento,))
+
+    def aplazar_outbox(self, ids, siguiente):
+        with self._transaccion() as cursor:
+            for id_evento in ids:
+                cursor.execute(self._sql(
+                    "UPDATE outbox_auditoria SET intentos = intentos + 1, siguiente_intento = ? WHERE id = ?"
+                ), (siguiente, id_evento))
+
+    def estado_outbox(self):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT COUNT(*), MIN(creado) FROM outbox_auditoria")
+            return tuple(cursor.fetchone())
+
+    def obtener_acuerdo(self, acuerdo_id):
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "SELECT estado, operaciones_ejecutadas, datos FROM acuerdos WHERE id = ?"
+            ), (acuerdo_id,))
+            fila = cursor.fetchone()
+        return self._acuerdo_desde_fila(fila) if fila else None
+
+    def listar_acuerdos(self):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT estado, operaciones_ejecutadas, datos FROM acuerdos ORDER BY timestamp, id")
+            return [self._acuerdo_desde_fila(fila) for fila in cursor.fetchall()]
+
+    def contar_acuerdos(self, estado=None):
+        with self._cursor() as cursor:
+            if estado is None:
+                cursor.execute("SELECT COUNT(*) FROM acuerdos")
+            else:
+                cursor.execute(self._sql("SELECT COUNT(*) FROM acuerdos WHERE estado = ?"), (estado,))
+            return cursor.fetchone()[0]
+
+    def total_operaciones_ejecutadas(self):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT COALESCE(SUM(operaciones_ejecutadas), 0) FROM acuerdos")
+            return int(cursor.fetchone()[0])
+
+    def vencimientos_activos(self):
+        """(id, vence) de los acuerdos activos con duracion_horas, para el planificador de caducidad"""
+        with self._cursor() as cursor:
+            cursor.execute("SELECT id, vence FROM acuerdos WHERE estado = 'activo' AND vence IS NOT NULL")
+            return cursor.fetchall()
+
+    def caducar_acuerdos(self, eventos):
+        """Pasa a 'caducado' los acuerdos aún activos y encola su evento en la misma transacción"""
+        caducados = []
+        with self._transaccion() as cursor:
+            for acuerdo_id, evento in eventos.items():
+                # Solo si sigue activo: con varias réplicas, solo una emite el evento
+                cursor.execute(self._sql(
+                    "UPDATE acuerdos SET estado = 'caducado' WHERE id = ? AND estado = 'activo'"
+                ), (acuerdo_id,))
+                if cursor.rowcount == 1:
+                    self._encolar_eventos(cursor, [evento])
+                    caducados.append(acuerdo_id)
+        return caducados
+
+    def _incrementar(self, cursor, acuerdo_id, cantidad):
+        # Incremento atómico en la base de datos: válido con varios workers o réplicas
+        cursor.execute(self._sql("""
+            UPDATE acuerdos SET operaciones_ejecutadas = operaciones_ejecutadas + ?
+            WHERE id = ? RETURNING operaciones_ejecutadas
+        """), (cantidad, acuerdo_id))
+        fila = cursor.fetchone()
+        return fila[0] if fila else None
+
+    def incrementar_operaciones(self, acuerdo_id, cantidad):
+        with self._cursor() as cursor:
+            return self._incrementar(cursor, acuerdo_id, cantidad)
+
+    def _guardar_operacion(self, cursor, operacion):
+        cursor.execute(self._sql("""
+            INSERT INTO operaciones (id, acuerdo_id, estado, tipo, timestamp, datos)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET estado = excluded.estado, datos = excluded.datos
+        """), (
+            operacion["id"], operacion["acuerdo_id"], operacion.get("estado"), _tipo_operacion(operacion),
+            _texto(operacion.get("fecha_ejecucion") or operacion.get("timestamp")),
+            json.dumps(operacion, default=str)
+        ))
+
+    def guardar_operacion(self, operacion, eventos=()):
+        with self._transaccion() as cursor:
+            self._guardar_operacion(cursor, operacion)
+            self._encolar_eventos(cursor, eventos)
+
+    def actualizar_operaciones(self, operaciones, eventos=()):
+        """Guarda el nuevo estado de varias operaciones y sus eventos en una sola transacción"""
+        with self._transaccion() as cursor:
+            for operacion in operaciones:
+                self._guardar_operacion(cursor, operacion)
+            self._encolar_eventos(cursor, eventos)
+
+    def obtener_operacion(self, operacion_id):
+        with self._cursor() as cursor:
+            cursor.execute(self._sql("SELECT datos FROM operaciones WHERE id = ?"), (operacion_id,))
+            fila = cursor.fetchone()
+        return self._documento(fila[0]) if fila else None
+
+    def aplicar_incrementos(self, deltas, operaciones):
+        """Aplica un lote de incrementos y sus evidencias en una sola transacción"""
+        totales = {}
+        with self._transaccion() as cursor:
+            for acuerdo_id, delta in deltas.items():
+                total = self._incrementar(cursor, acuerdo_id, delta)
+                if total is not None:
+                    totales[acuerdo_id] = total
+            for operacion in operaciones:
+                self._guardar_operacion(cursor, operacion)
+        return totales
+
+    def contar_operaciones(self, estado=None):
+        with self._cursor() as cursor:
+            if estado is None:
+                cursor.execute("SELECT COUNT(*) FROM operaciones")
+            else:
+                cursor.execute(self._sql("SELECT COUNT(*) FROM operaciones WHERE estado = ?"), (estado,))
+            return cursor.fetchone()[0]
+
+    def ultimas_operaciones(self, limite):
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "SELECT datos FROM operaciones ORDER BY timestamp DESC, id DESC LIMIT ?"
+            ), (limite,))
+            filas = cursor.fetchall()
+        return [self._documento(fila[0]) for fila in reversed(filas)]
+
+    def resumen_estadisticas(self):
+        """Recuento agrupado para reconstruir las estadísticas en memoria al arrancar"""
+        with self._cursor() as cursor:
+            cursor.execute("""
+                SELECT estado, tipo_datos, finalidad, COUNT(*) FROM acuerdos
+                GROUP BY estado, tipo_datos, finalidad
+            """)
+            acuerdos = cursor.fetchall()
+            cursor.execute("SELECT COALESCE(SUM(operaciones_ejecutadas), 0) FROM acuerdos")
+            usos = int(cursor.fetchone()[0])
+            cursor.execute("SELECT estado, tipo, COUNT(*) FROM operaciones GROUP BY estado, tipo")
+            operaciones = cursor.fetchall()
+        return {"acuerdos": acuerdos, "usos": usos, "operaciones": operaciones}
+
+
+class AlmacenSQLite(AlmacenSQL):
+    """Fichero SQLite local en modo WAL: lectores concurrentes con un escritor"""
+    nombre = "sqlite"
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._conexiones = []
+        self._lock = threading.Lock()
+
+    def _conexion(self):
+        # Una conexión por hilo del ejecutor; en autocommit cada sentencia es su transacción
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=5, isolation_level=None, check_same_thread=False)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+            with self._lock:
+                self._conexiones.append(conexion)
+        return conexion
+
+    @contextmanager
+    def _cursor(self):
+        cursor = self._conexion().cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def _columnas(self, cursor, tabla):
+        cursor.execute(f"PRAGMA table_info({tabla})")
+        return {fila[1] for fila in cursor.fetchall()}
+
+    @contextmanager
+    def _transaccion(self):
+        with self._cursor() as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def cerrar(self):
+        with self._lock:
+            for conexion in self._conexiones:
+                conexion.close()
+            self._conexiones.clear()
+        self._local = threading.local()
+
+
+class AlmacenPostgres(AlmacenSQL):
+    """PostgreSQL compartido: permite varias réplicas de servicio-sela"""
+    nombre = "postgres"
+    marcador = "%s"
+    tipo_json = "JSONB"
+
+    def __init__(self, url):
+        self.url = url
+        self.pool = None
+
+    def inicializar(self):
+        if psycopg2 is None:
+            raise RuntimeError("SELA_ALMACENAMIENTO=postgres requiere psycopg2")
+        self.pool = ThreadedConnectionPool(1, SELA_DB_HILOS, self.url)
+        super().inicializar()
+
+    def _columnas(self, cursor, tabla):
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s",
+            (tabla,)
+        )
+        return {fila[0] for fila in cursor.fetchall()}
+
+    @contextmanager
+    def _cursor(self):
+        conexion = self.pool.getconn()
+        try:
+            with conexion.cursor() as cursor:
+                yield cursor
+            conexion.commit()
+        except Exception:
+            conexion.rollback()
+            raise
+        finally:
+            self.pool.putconn(conexion)
+
+    def cerrar(self):
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
+
+
+class CacheAcuerdos:
+    """LRU acotada con caducidad para leer acuerdos sin ir a la base de datos.
+
+    El TTL limita cuánto tarda una réplica en ver los cambios hechos por otra.
+    """
+
+    def __init__(self, maximo, ttl):
+        self.maximo = maximo
+        self.ttl = ttl
+        self.entradas = OrderedDict()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, acuerdo_id):
+        entrada = self.entradas.get(acuerdo_id)
+        if entrada is None or entrada[0] < time.monotonic():
+            self.fallos += 1
+            return None
+        self.entradas.move_to_end(acuerdo_id)
+        self.aciertos += 1
+        return entrada[1]
+
+    def descartar(self, acuerdo_id):
+        self.entradas.pop(acuerdo_id, None)
+
+    def guardar(self, acuerdo):
+        self.entradas[acuerdo["id"]] = (time.monotonic() + self.ttl, acuerdo)
+        self.entradas.move_to_end(acuerdo["id"])
+        while len(self.entradas) > self.maximo:
+            self.entradas.popitem(last=False)
+
+    def estado(self):
+        consultas = self.aciertos + self.fallos
+        return {
+            "entradas": len(self.entradas),
+            "maximo": self.maximo,
+            "ttl_segundos": self.ttl,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": round(self.aciertos / consultas, 3) if consultas else None
+        }
+
+
+class Almacenamiento:
+    """Acceso de los endpoints a acuerdos y operaciones, sea cual sea el backend.
+
+    Con un backend bloqueante las llamadas van a un pool de hilos para no
+    parar el bucle de eventos, y los acuerdos se leen a través de la caché.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.cache = CacheAcuerdos(SELA_CACHE_MAX, SELA_CACHE_TTL) if backend.bloqueante else None
+        self.ejecutor = None
+
+    def inicializar(self):
+        if self.backend.bloqueante:
+            self.ejecutor = ThreadPoolExecutor(max_workers=SELA_DB_HILOS, thread_name_prefix="sela-db")
+        self.backend.inicializar()
+
+    def cerrar(self):
+        if self.ejecutor:
+            self.ejecutor.shutdown(wait=True)
+            self.ejecutor = None
+        self.backend.cerrar()
+
+    async def _ejecutar(self, funcion, *args):
+        if self.ejecutor is None:
+            return funcion(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.ejecutor, funcion, *args)
+
+    async def obtener_acuerdo(self, acuerdo_id):
+        if self.cache is not None:
+            acuerdo = self.cache.obtener(acuerdo_id)
+            if acuerdo is not None:
+                return acuerdo
+        acuerdo = await self._ejecutar(self.backend.obtener_acuerdo, acuerdo_id)
+        if acuerdo is not None and self.cache is not None:
+            self.cache.guardar(acuerdo)
+        return acuerdo
+
+    async def guardar_acuerdo(self, acuerdo, eventos=()):
+        """Guarda un acuerdo nuevo junto con sus eventos de auditoría (outbox)"""
+        await self._ejecutar(self.backend.guardar_acuerdo, acuerdo, eventos)
+        if self.cache is not None:
+            self.cache.guardar(acuerdo)
+        estadisticas.acuerdo_creado(acuerdo)
+        planificador.programar(acuerdo)
+        if eventos:
+            despachador.avisar()
+
+    async def listar_acuerdos(self):
+        return await self._ejecutar(self.backend.listar_acuerdos)
+
+    async def contar_acuerdos(self, estado=None):
+        return await self._ejecutar(self.backend.contar_acuerdos, estado)
+
+    async def total_operaciones_ejecutadas(self):
+        return await self._ejecutar(self.backend.total_operaciones_ejecutadas)
+
+    async def vencimientos_activos(self):
+        return await self._ejecutar(self.backend.vencimientos_activos)
+
+    async def caducar_acuerdos(self, vencidos):
+        """Marca como caducados los acuerdos (vence, id) que sigan activos; devuelve sus ids"""
+        eventos = {
+            acuerdo_id: evento_auditoria(
+                "CADUCIDAD_ACUERDO", acuerdo_id,
+                detalles=f"Acuerdo {acuerdo_id} caducado por duracion_horas",
+                vencimiento=datetime.fromtimestamp(vence).isoformat()
+            )
+            for vence, acuerdo_id in vencidos
+        }
+        caducados = await self._ejecutar(self.backend.caducar_acuerdos, eventos)
+        if self.cache is not None:
+            for acuerdo_id in eventos:
+                self.cache.descartar(acuerdo_id)
+        for _ in caducados:
+            estadisticas.acuerdo_cambia_estado("activo", "caducado")
+        if caducados:
+            despachador.avisar()
+        return caducados
+
+    async def aplicar_incrementos(self, deltas, operaciones):
+        return await self._ejecutar(self.backend.aplicar_incrementos, deltas, operaciones)
+
+    async def guardar_operacion(self, operacion, eventos=()):
+        """Guarda una operación nueva junto con sus eventos de auditoría (outbox)"""
+        await self._ejecutar(self.backend.guardar_operacion, operacion, eventos)
+        estadisticas.operacion_registrada(operacion)
+        if eventos:
+            despachador.avisar()
+
+    async def actualizar_operaciones(self, operaciones, anterior, eventos=()):
+        """Guarda el cambio de estado (desde `anterior`) de operaciones ya registradas"""
+        await self._ejecutar(self.backend.actualizar_operaciones, operaciones, eventos)
+        for operacion in operaciones:
+            estadisticas.operacion_cambia_estado(anterior, operacion.get("estado"))
+        if eventos:
+            despachador.avisar()
+
+    async def obtener_operacion(self, operacion_id):
+        return await self._ejecutar(self.backend.obtener_operacion, operacion_id)
+
+    async def contar_operaciones(self, estado=None):
+        return await self._ejecutar(self.backend.contar_operaciones, estado)
+
+    async def ultimas_operaciones(self, limite):
+        return await self._ejecutar(self.backend.ultimas_operaciones, limite)
+
+    async def resumen_estadisticas(self):
+        return await self._ejecutar(self.backend.resumen_estadisticas)
+
+    async def pendientes_outbox(self, limite):
+        return await self._ejecutar(self.backend.pendientes_outbox, limite, time.time())
+
+    async def confirmar_outbox(self, ids):
+        await self._ejecutar(self.backend.confirmar_outbox, ids)
+
+    async def aplazar_outbox(self, ids, siguiente):
+        await self._ejecutar(self.backend.aplazar_outbox, ids, siguiente)
+
+    async def estado_outbox(self):
+        return await self._ejecutar(self.backend.estado_outbox)
+
+    def estado(self):
+        return {
+            "backend": self.backend.nombre,
+            "cache": self.cache.estado() if self.cache is not None else None
+        }
+
+
+def crear_backend():
+    if SELA_ALMACENAMIENTO == "memoria":
+        return AlmacenMemoria()
+    if SELA_ALMACENAMIENTO == "sqlite":
+        return AlmacenSQLite(SELA_SQLITE_RUTA)
+    if SELA_ALMACENAMIENTO == "postgres":
+        return AlmacenPostgres(SELA_DATABASE_URL)
+    raise ValueError(f"SELA_ALMACENAMIENTO no válido: '{SELA_ALMACENAMIENTO}' (memoria, sqlite o postgres)")
+
+
+almacen = Almacenamiento(crear_backend())
+
+
+# --- CONTADORES DE USO Y CUOTAS ---
+# Cada cuánto se vuelcan al almacenamiento los incrementos acumulados en memoria
+SELA_CONTADORES_INTERVALO = float(os.getenv('SELA_CONTADORES_INTERVALO', 0.5))
+
+
+class UsoRechazado(Exception):
+    """El acuerdo no admite más uso: inactivo, caducado o sin cuota"""
+
+    def __init__(self, motivo, mensaje, restante=None):
+        super().__init__(mensaje)
+        self.motivo = motivo
+        self.mensaje = mensaje
+        self.restante = restante
+
+    def detalle(self):
+        detalle = {"motivo": self.motivo, "mensaje": self.mensaje}
+        if self.restante is not None:
+            detalle["restante"] = self.restante
+        return detalle
+
+
+def _numero(valor, tipo):
+    try:
+        return tipo(valor) if valor is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _vencimiento(acuerdo):
+    """Instante (segundos epoch) en que caduca el acuerdo, o None si no tiene duracion_horas"""
+    horas = _numero(acuerdo.get("duracion_horas"), float)
+    if horas is None:
+        return None
+    try:
+        # timestamp es hora local sin zona, igual que time.time() al convertirla
+        return datetime.fromisoformat(str(acuerdo.get("timestamp"))).timestamp() + horas * 3600
+    except ValueError:
+        return None
+
+
+class ContadorAcuerdo:
+    """Uso de un acuerdo: lo confirmado en el almacenamiento más lo aún no volcado"""
+    __slots__ = ("limite", "vence", "estado", "confirmado", "pendiente", "en_vuelo")
+
+    def __init__(self, acuerdo):
+        self.limite = _numero(acuerdo.get("volumen_maximo"), int)
+        self.vence = _vencimiento(acuerdo)
+        self.estado = acuerdo.get("estado", "activo")
+        self.confirmado = acuerdo.get("operaciones_ejecutadas", 0) or 0
+        self.pendiente = 0
+        self.en_vuelo = 0
+
+    @property
+    def total(self):
+        return self.confirmado + self.en_vuelo + self.pendiente
+
+    def comprobar(self, cantidad, ahora):
+        if self.vence is not None and ahora >= self.vence:
+            raise UsoRechazado("caducado", "El acuerdo ha superado su duracion_horas")
+        if self.estado != "activo":
+            raise UsoRechazado("inactivo", f"El acuerdo está en estado '{self.estado}'")
+        if self.limite is not None and self.total + cantidad > self.limite:
+            restante = max(self.limite - self.total, 0)
+            raise UsoRechazado("cuota_agotada", f"Se superaría volumen_maximo ({self.limite})", restante)
+
+
+class ContadoresUso:
+    """Admisión de uso contra volumen_maximo y duracion_horas con contadores en memoria.
+
+    Admitir o rechazar es una consulta a un diccionario sin esperas, así que es
+    atómico dentro del bucle de eventos. Los incrementos admitidos (y su registro
+    en operaciones) se vuelcan cada SELA_CONTADORES_INTERVALO segundos en una
+    sola transacción, con un UPDATE atómico por acuerdo; el total que devuelve la
+    base de datos incorpora el uso registrado por otras réplicas.
+    """
+
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self.contadores: Dict[str, ContadorAcuerdo] = {}
+        self.sucios = set()
+        self.operaciones = []
+        self.sin_volcar = 0
+        self.lock = asyncio.Lock()
+        self.tarea = None
+        # Cuota reservada por /ejecutar que servicio-anonimizacion aún no ha consumido:
+        # reserva_id -> [acuerdo_id, cantidad]
+        self.reservas: Dict[str, list] = {}
+        self.estadisticas = {"admitidos": 0, "liberados": 0, "rechazados": 0, "volcados": 0, "errores_volcado": 0}
+        self.rechazos = Counter()
+
+    async def _contador(self, acuerdo_id):
+        contador = self.contadores.get(acuerdo_id)
+        if contador is None:
+            acuerdo = await almacen.obtener_acuerdo(acuerdo_id)
+            if acuerdo is None:
+                return None
+            # Otra petición pudo crearlo mientras se leía el acuerdo
+            contador = self.contadores.setdefault(acuerdo_id, ContadorAcuerdo(acuerdo))
+        return contador
+
+    def _rechazar(self, error):
+        self.estadisticas["rechazados"] += 1
+        self.rechazos[error.motivo] += 1
+        raise error
+
+    async def comprobar(self, acuerdo_id, cantidad=1):
+        """Comprueba sin consumir; None si el acuerdo no existe"""
+        contador = await self._contador(acuerdo_id)
+        if contador is not None:
+            try:
+                contador.comprobar(cantidad, time.time())
+            except UsoRechazado as e:
+                self._rechazar(e)
+        return contador
+
+    def _sumar(self, acuerdo_id, contador, cantidad, operacion):
+        contador.pendiente += cantidad
+        self.sucios.add(acuerdo_id)
+        self.sin_volcar += cantidad
+        # La evidencia se persiste en el siguiente volcado, pero cuenta desde ya
+        estadisticas.uso(cantidad)
+        if operacion is not None:
+            self.operaciones.append(operacion)
+            estadisticas.operacion_registrada(operacion)
+
+    async def incrementar(self, acuerdo_id, cantidad, operacion=None):
+        """Admite y consume `cantidad`; devuelve el nuevo total o None si no existe.
+
+        `operacion` es el registro de evidencia que se guarda con el incremento.
+        """
+        contador = await self._contador(acuerdo_id)
+        if contador is None:
+            return None
+        try:
+            contador.comprobar(cantidad, time.time())
+        except UsoRechazado as e:
+            self._rechazar(e)
+        self._sumar(acuerdo_id, contador, cantidad, operacion)
+        self.estadisticas["admitidos"] += cantidad
+        return contador.total
+
+    async def liberar(self, acuerdo_id, cantidad, operacion=None):
+        """Devuelve uso consumido y no aprovechado; None si el acuerdo no existe"""
+        contador = await self._contador(acuerdo_id)
+        if contador is None:
+            return None
+        cantidad = min(cantidad, max(contador.total, 0))
+        if cantidad:
+            self._sumar(acuerdo_id, contador, -cantidad, operacion)
+            self.estadisticas["liberados"] += cantidad
+        return contador.total
+
+    async def reservar(self, acuerdo_id, cantidad, reserva_id):
+        """Como incrementar, pero servicio-anonimizacion podrá consumirlo con `reserva_id`"""
+        total = await self.incrementar(acuerdo_id, cantidad)
+        if total is not None:
+            self.reservas[reserva_id] = [acuerdo_id, cantidad]
+        return total
+
+    def agrupar_reservas(self, reserva_ids):
+        """Une las reservas de un mismo acuerdo bajo un id nuevo (un envío agrupado)"""
+        reservas = [self.reservas.pop(reserva_id) for reserva_id in reserva_ids if reserva_id in self.reservas]
+        if not reservas:
+            return None
+        nueva = str(uuid.uuid4())
+        self.reservas[nueva] = [reservas[0][0], sum(cantidad for _, cantidad in reservas)]
+        return nueva
+
+    def consumir_reserva(self, reserva_id, acuerdo_id, cantidad):
+        """True si `cantidad` ya estaba reservada: no se vuelve a contar"""
+        reserva = self.reservas.get(reserva_id)
+        if reserva is None or reserva[0] != acuerdo_id or reserva[1] < cantidad:
+            return False
+        reserva[1] -= cantidad
+        if not reserva[1]:
+            del self.reservas[reserva_id]
+        return True
+
+    async def cancelar_reserva(self, reserva_id):
+        """Libera lo que quede sin consumir de una reserva"""
+        reserva = self.reservas.pop(reserva_id, None)
+        if reserva is not None and reserva[1]:
+            await self.liberar(*reserva)
+
+    def superponer(self, acuerdo):
+        """Copia del acuerdo con el uso incluyendo lo aún no volcado"""
+        contador = self.contadores.get(acuerdo["id"])
+        if contador is None or contador.total == acuerdo.get("operaciones_ejecutadas"):
+            return acuerdo
+        return {**acuerdo, "operaciones_ejecutadas": contador.total}
+
+    async def volcar(self):
+        async with self.lock:
+            if not self.sucios and not self.operaciones:
+                return
+            deltas = {}
+            for acuerdo_id in self.sucios:
+                contador = self.contadores[acuerdo_id]
+                deltas[acuerdo_id] = contador.pendiente
+                contador.en_vuelo += contador.pendiente
+                contador.pendiente = 0
+            self.sucios = set()
+            operaciones, self.operaciones = self.operaciones, []
+            try:
+                totales = await almacen.aplicar_incrementos(deltas, operaciones)
+            except Exception as e:
+                # Se devuelve todo a pendiente para el siguiente intento
+                for acuerdo_id, delta in deltas.items():
+                    contador = self.contadores[acuerdo_id]
+                    contador.en_vuelo -= delta
+                    contador.pendiente += delta
+                    self.sucios.add(acuerdo_id)
+                self.operaciones[:0] = operaciones
+                self.estadisticas["errores_volcado"] += 1
+                print(f"Error volcando contadores de uso: {e}")
+                return
+            for acuerdo_id, delta in deltas.items():
+                contador = self.contadores[acuerdo_id]
+                contador.en_vuelo -= delta
+                if acuerdo_id in totales:
+                    contador.confirmado = totales[acuerdo_id]
+                self.sin_volcar -= delta
+            self.estadisticas["volcados"] += 1
+
+    async def _bucle(self):
+        while True:
+            await asyncio.sleep(self.intervalo)
+            await self.volcar()
+
+    def iniciar(self):
+        self.tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        if self.tarea:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+        await self.volcar()
+
+    def estado(self):
+        return {
+            "acuerdos": len(self.contadores),
+            "uso_sin_volcar": self.sin_volcar,
+            "reservas_pendientes": len(self.reservas),
+            "intervalo_volcado_segundos": self.intervalo,
+            **self.estadisticas,
+            "rechazos_por_motivo": dict(self.rechazos)
+        }
+
+
+contadores = ContadoresUso(SELA_CONTADORES_INTERVALO)
+
+
+# --- ESTADÍSTICAS INCREMENTALES Y LATENCIAS ---
+# Con PostgreSQL compartido, cada cuánto se recuentan las estadísticas para
+# incorporar lo escrito por otras réplicas (0 = nunca)
+SELA_ESTADISTICAS_RESINCRONIZAR = float(os.getenv('SELA_ESTADISTICAS_RESINCRONIZAR', 60))
+
+
+class EstadisticasSela:
+    """Recuentos por estado, tipo_datos, finalidad y tipo de operación.
+
+    Se reconstruyen una vez desde el almacenamiento al arrancar y después se
+    actualizan en cada escritura, así que los endpoints de estadísticas no
+    recorren acuerdos ni operaciones.
+    """
+
+    def __init__(self):
+        self.reiniciar()
+
+    def reiniciar(self):
+        self.acuerdos_por_estado = Counter()
+        self.acuerdos_por_tipo_datos = Counter()
+        self.acuerdos_por_finalidad = Counter()
+        self.operaciones_por_estado = Counter()
+        self.operaciones_por_tipo = Counter()
+        self.total_acuerdos = 0
+        self.total_operaciones = 0
+        self.usos = 0
+        self.ultimas = deque(maxlen=5)
+
+    def cargar(self, resumen, ultimas=()):
+        self.reiniciar()
+        for estado, tipo_datos, finalidad, n in resumen["acuerdos"]:
+            self._sumar_acuerdo(estado, tipo_datos, finalidad, n)
+        for estado, tipo, n in resumen["operaciones"]:
+            self._sumar_operacion(estado, tipo, n)
+        self.usos = resumen["usos"]
+        self.ultimas.extend(ultimas)
+
+    def _sumar_acuerdo(self, estado, tipo_datos, finalidad, n=1):
+        self.total_acuerdos += n
+        self.acuerdos_por_estado[estado] += n
+        if tipo_datos is not None:
+            self.acuerdos_por_tipo_datos[tipo_datos] += n
+        if finalidad is not None:
+            self.acuerdos_por_finalidad[finalidad] += n
+
+    def _sumar_operacion(self, estado, tipo, n=1):
+        self.total_operaciones += n
+        if estado is not None:
+            self.operaciones_por_estado[estado] += n
+        if tipo is not None:
+            self.operaciones_por_tipo[tipo] += n
+
+    def acuerdo_creado(self, acuerdo):
+        self._sumar_acuerdo(acuerdo.get("estado"), _texto(acuerdo.get("tipo_datos")), _texto(acuerdo.get("finalidad")))
+
+    def acuerdo_cambia_estado(self, anterior, nuevo):
+        self.acuerdos_por_estado[anterior] -= 1
+        self.acuerdos_por_estado[nuevo] += 1
+
+    def operacion_registrada(self, operacion):
+        self._sumar_operacion(operacion.get("estado"), _tipo_operacion(operacion))
+        self.ultimas.append(operacion)
+
+    def operacion_cambia_estado(self, anterior, nuevo):
+        if anterior is not None:
+            self.operaciones_por_estado[anterior] -= 1
+        self.operaciones_por_estado[nuevo] += 1
+
+    def uso(self, cantidad):
+        self.usos += cantidad
+
+
+def _sin_ceros(contador):
+    return {clave: n for clave, n in contador.items() if n}
+
+
+estadisticas = EstadisticasSela()
+
+
+class HistogramaLatencias:
+    """Histograma de latencias con cubetas fijas; los percentiles se interpolan"""
+    LIMITES_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.cubetas = [0] * (len(self.LIMITES_MS) + 1)
+        self.total = 0
+        self.suma_ms = 0.0
+        self.maximo_ms = 0.0
+        self.errores = 0
+
+    def observar(self, ms, error=False):
+        self.cubetas[bisect.bisect_left(self.LIMITES_MS, ms)] += 1
+        self.total += 1
+        self.suma_ms += ms
+        if ms > self.maximo_ms:
+            self.maximo_ms = ms
+        if error:
+            self.errores += 1
+
+    def percentil(self, p):
+        if not self.total:
+            return None
+        objetivo = p / 100 * self.total
+        acumulado = 0
+        for i, n in enumerate(self.cubetas):
+            if n and acumulado + n >= objetivo:
+                inferior = self.LIMITES_MS[i - 1] if i else 0.0
+                superior = min(self.LIMITES_MS[i], self.maximo_ms) if i < len(self.LIMITES_MS) else self.maximo_ms
+                return round(inferior + (superior - inferior) * (objetivo - acumulado) / n, 3)
+            acumulado += n
+        return round(self.maximo_ms, 3)
+
+    def resumen(self):
+        return {
+            "peticiones": self.total,
+            "errores_5xx": self.errores,
+            "promedio_ms": round(self.suma_ms / self.total, 3) if self.total else None,
+            "p50_ms": self.percentil(50),
+            "p95_ms": self.percentil(95),
+            "p99_ms": self.percentil(99),
+            "maximo_ms": round(self.maximo_ms, 3)
+        }
+
+
+inicio_servicio = time.time()
+latencias = HistogramaLatencias()
+latencias_por_ruta: Dict[str, HistogramaLatencias] = {}
+
+
+@app.middleware("http")
+async def medir_latencia(request: Request, call_next):
+    inicio = time.perf_counter()
+    error = True
+    try:
+        respuesta = await call_next(request)
+        error = respuesta.status_code >= 500
+        return respuesta
+    finally:
+        ms = (time.perf_counter() - inicio) * 1000
+        # Plantilla de la ruta (no la URL) para que el número de histogramas esté acotado
+        ruta = request.scope.get("route")
+        clave = f"{request.method} {ruta.path}" if ruta is not None else "otras"
+        latencias.observar(ms, error)
+        histograma = latencias_por_ruta.get(clave)
+        if histograma is None:
+            histograma = latencias_por_ruta[clave] = HistogramaLatencias()
+        histograma.observar(ms, error)
+
+
+def resumen_rendimiento():
+    global_ = latencias.resumen()
+    return {
+        "uptime_segundos": round(time.time() - inicio_servicio),
+        "peticiones": global_["peticiones"],
+        "tasa_exito": (
+            f"{100 * (1 - latencias.errores / latencias.total):.1f}%" if latencias.total else None
+        ),
+        "tiempo_respuesta_promedio_ms": global_["promedio_ms"],
+        "tiempo_respuesta_p50_ms": global_["p50_ms"],
+        "tiempo_respuesta_p95_ms": global_["p95_ms"],
+        "tiempo_respuesta_p99_ms": global_["p99_ms"],
+        "disponibilidad_servicios": monitor.disponibilidad(),
+        "por_ruta": {clave: h.resumen() for clave, h in sorted(latencias_por_ruta.items())}
+    }
+
+
+async def cargar_estadisticas():
+    resumen = await almacen.resumen_estadisticas()
+    ultimas = await almacen.ultimas_operaciones(estadisticas.ultimas.maxlen)
+    estadisticas.cargar(resumen, ultimas)
+    # Lo admitido por los contadores y aún no volcado no está en el recuento
+    estadisticas.uso(contadores.sin_volcar)
+    for operacion in contadores.operaciones:
+        estadisticas.operacion_registrada(operacion)
+
+
+async def _resincronizar_estadisticas():
+    while True:
+        await asyncio.sleep(SELA_ESTADISTICAS_RESINCRONIZAR)
+        try:
+            await cargar_estadisticas()
+        except Exception as e:
+            print(f"Error resincronizando estadísticas: {e}")
+
+
+tarea_estadisticas = None
+
+
+# --- CLIENTE HTTP COMPARTIDO Y MONITOR DE DEPENDENCIAS ---
+ANONIMIZACION_SERVICE_URL = os.getenv('ANONIMIZACION_SERVICE_URL', 'http://servicio-anonimizacion:8001')
+AUDITORIA_SERVICE_URL = os.getenv('AUDITORIA_SERVICE_URL', 'http://servicio-auditoria:8002')
+SELA_HTTP_MAX_CONEXIONES = int(os.getenv('SELA_HTTP_MAX_CONEXIONES', 100))
+SELA_HTTP_KEEPALIVE = int(os.getenv('SELA_HTTP_KEEPALIVE', 20))
+SELA_HTTP_TIMEOUT = float(os.getenv('SELA_HTTP_TIMEOUT', 5))
+# Sondeo de /health de las dependencias en segundo plano
+SELA_HEALTH_INTERVALO = float(os.getenv('SELA_HEALTH_INTERVALO', 5))
+SELA_HEALTH_TIMEOUT = float(os.getenv('SELA_HEALTH_TIMEOUT', 2))
+SELA_HEALTH_TTL = float(os.getenv('SELA_HEALTH_TTL', 15))
+
+# Un único cliente para toda la vida del proceso: reutiliza conexiones keep-alive
+cliente_http: Optional[httpx.AsyncClient] = None
+
+
+def crear_cliente_http():
+    return httpx.AsyncClient(
+        timeout=SELA_HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=SELA_HTTP_MAX_CONEXIONES,
+                            max_keepalive_connections=SELA_HTTP_KEEPALIVE),
+        http2=h2 is not None
+    )
+
+
+class MonitorDependencias:
+    """Sondea en paralelo el /health de cada dependencia y guarda el resultado.
+
+    /api/v1/health/detallado responde desde el último sondeo sin esperar a la
+    red; si este tiene más de `ttl` segundos se lanza otro en segundo plano y
+    las dependencias se informan como "desconocido".
+    """
+
+    def __init__(self, dependencias, intervalo, timeout, ttl):
+        self.dependencias = dependencias
+        self.intervalo = intervalo
+        self.timeout = timeout
+        self.ttl = ttl
+        self.resultados = {nombre: {"estado": "checking", "puerto": puerto}
+                           for nombre, (_, puerto) in dependencias.items()}
+        self.actualizado = None
+        self.sondeos = Counter()
+        self.sondeos_ok = Counter()
+        self.sondeo = None
+        self.tarea = None
+
+    async def _sondear(self, nombre, url):
+        inicio = time.perf_counter()
+        detalle = None
+        try:
+            respuesta = await cliente_http.get(f"{url}/health", timeout=self.timeout)
+            estado = "ok" if respuesta.status_code == 200 else "error"
+            if estado != "ok":
+                detalle = f"status {respuesta.status_code}"
+        except Exception as e:
+            estado = "error"
+            detalle = str(e) or type(e).__name__
+        resultado = {
+            "estado": estado,
+            "puerto": self.dependencias[nombre][1],
+            "latencia_ms": round((time.perf_counter() - inicio) * 1000, 1),
+            "comprobado": datetime.now().isoformat()
+        }
+        if detalle:
+            resultado["detalle"] = detalle
+        return nombre, resultado
+
+    async def sondear(self):
+        resultados = await asyncio.gather(*(
+            self._sondear(nombre, url) for nombre, (url, _) in self.dependencias.items()
+        ))
+        for nombre, resultado in resultados:
+            self.resultados[nombre] = resultado
+            self.sondeos[nombre] += 1
+            if resultado["estado"] == "ok":
+                self.sondeos_ok[nombre] += 1
+        self.actualizado = time.monotonic()
+
+    def refrescar(self):
+        """Lanza un sondeo si no hay otro en curso"""
+        if self.sondeo is None or self.sondeo.done():
+            self.sondeo = asyncio.create_task(self.sondear())
+        return self.sondeo
+
+    async def _bucle(self):
+        while True:
+            await self.refrescar()
+            await asyncio.sleep(self.intervalo)
+
+    def iniciar(self):
+        self.tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        for tarea in (self.tarea, self.sondeo):
+            if tarea and not tarea.done():
+                tarea.cancel()
+                try:
+                    await tarea
+                except asyncio.CancelledError:
+                    pass
+        self.tarea = self.sondeo = None
+
+    def instantanea(self):
+        if self.actualizado is None:
+            return {nombre: dict(r) for nombre, r in self.resultados.items()}
+        antiguedad = time.monotonic() - self.actualizado
+        if antiguedad > self.ttl:
+            self.refrescar()
+        instantanea = {}
+        for nombre, resultado in self.resultados.items():
+            resultado = dict(resultado, antiguedad_segundos=round(antiguedad, 1))
+            if antiguedad > self.ttl:
+                resultado["estado"] = "desconocido"
+            instantanea[nombre] = resultado
+        return instantanea
+
+    def disponibilidad(self):
+        return {
+            nombre: f"{100 * self.sondeos_ok[nombre] / self.sondeos[nombre]:.1f}%" if self.sondeos[nombre] else None
+            for nombre in self.dependencias
+        }
+
+
+monitor = MonitorDependencias(
+    {"anonimizacion": (ANONIMIZACION_SERVICE_URL, 8001), "auditoria": (AUDITORIA_SERVICE_URL, 8002)},
+    SELA_HEALTH_INTERVALO, SELA_HEALTH_TIMEOUT, SELA_HEALTH_TTL
+)
+
+
+# --- OUTBOX DE EVENTOS DE AUDITORÍA ---
+# Eventos por lote enviados a /registrar/lote y espera máxima entre rondas sin avisos
+SELA_OUTBOX_LOTE = int(os.getenv('SELA_OUTBOX_LOTE', 200))
+SELA_OUTBOX_INTERVALO = float(os.getenv('SELA_OUTBOX_INTERVALO', 1))
+# Backoff exponencial (con jitter) tras un envío fallido
+SELA_OUTBOX_BACKOFF_BASE = float(os.getenv('SELA_OUTBOX_BACKOFF_BASE', 1))
+SELA_OUTBOX_BACKOFF_MAX = float(os.getenv('SELA_OUTBOX_BACKOFF_MAX', 300))
+# Al apagar, segundos como máximo para vaciar el outbox
+SELA_OUTBOX_DRENADO = float(os.getenv('SELA_OUTBOX_DRENADO', 5))
+
+
+def evento_auditoria(operacion, acuerdo_id=None, resultado="exito", **metadatos):
+    """Evento para servicio-auditoria; operacion_id es su clave de idempotencia"""
+    return {
+        "operacion_id": str(uuid.uuid4()),
+        "operacion": operacion,
+        "servicio_origen": "SELA-Main",
+        "acuerdo_id": acuerdo_id,
+        "resultado": resultado,
+        "timestamp": datetime.now().isoformat(),
+        "metadatos": metadatos
+    }
+
+
+class DespachadorAuditoria:
+    """Entrega por lotes los eventos del outbox a servicio-auditoria.
+
+    Un evento solo sale del outbox cuando auditoría confirma el lote. Si el envío
+    falla, el lote se aplaza con backoff exponencial y se reintenta tal cual:
+    auditoría descarta por operacion_id los eventos que ya tenía, así que un
+    reintento tras una respuesta perdida no duplica nada.
+    """
+
+    def __init__(self, lote, intervalo):
+        self.lote = lote
+        self.intervalo = intervalo
+        self.despertar = None
+        self.tarea = None
+        self.pendientes = 0
+        self.mas_antiguo = None
+        self.ultimo_error = None
+        self.pausa = 0
+        self.metricas = {"lotes": 0, "enviados": 0, "duplicados": 0, "fallos": 0}
+
+    def avisar(self):
+        if self.despertar is not None:
+            self.despertar.set()
+
+    async def despachar(self):
+        """Envía un lote; devuelve cuántos eventos confirmó auditoría"""
+        lote = await almacen.pendientes_outbox(self.lote)
+        if not lote:
+            return 0
+        ids = [id_evento for id_evento, _, _ in lote]
+        try:
+            respuesta = await cliente_http.post(
+                f"{AUDITORIA_SERVICE_URL}/registrar/lote",
+                json={"eventos": [evento for _, evento, _ in lote]}
+            )
+            respuesta.raise_for_status()
+            resultado = respuesta.json()
+        except Exception as e:
+            intentos = max(intentos for _, _, intentos in lote) + 1
+            espera = min(SELA_OUTBOX_BACKOFF_BASE * 2 ** (intentos - 1), SELA_OUTBOX_BACKOFF_MAX)
+            self.pausa = espera * random.uniform(0.5, 1)
+            await almacen.aplazar_outbox(ids, time.time() + self.pausa)
+            self.metricas["fallos"] += 1
+            self.ultimo_error = f"{datetime.now().isoformat()}: {str(e) or type(e).__name__}"
+            print(f"Error enviando {len(lote)} eventos a auditoría (intento {intentos}): {self.ultimo_error}")
+            return 0
+        await almacen.confirmar_outbox(ids)
+        self.metricas["lotes"] += 1
+        self.metricas["enviados"] += len(ids)
+        self.metricas["duplicados"] += resultado.get("duplicados", 0)
+        return len(ids)
+
+    async def _actualizar_estado(self):
+        self.pendientes, self.mas_antiguo = await almacen.estado_outbox()
+
+    async def _bucle(self):
+        while True:
+            # Se limpia antes de leer el outbox para no perder avisos llegados durante el envío
+            self.despertar.clear()
+            try:
+                enviados = await self.despachar()
+                await self._actualizar_estado()
+            except Exception as e:
+                print(f"Error en el despachador de auditoría: {e}")
+                enviados = 0
+            if self.pausa:
+                # Tras un fallo no se vuelve a intentar hasta cumplir el backoff,
+                # aunque lleguen eventos nuevos
+                pausa, self.pausa = self.pausa, 0
+                await asyncio.sleep(pausa)
+            elif enviados < self.lote:
+                try:
+                    await asyncio.wait_for(self.despertar.wait(), self.intervalo)
+                except asyncio.TimeoutError:
+                    pass
+
+    def iniciar(self):
+        self.despertar = asyncio.Event()
+        self.tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self, drenado):
+        if self.tarea:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+        # Último intento de vaciar el outbox; con almacenamiento persistente lo que
+        # quede se enviará en el próximo arranque
+        limite = time.monotonic() + drenado
+        try:
+            while time.monotonic() < limite and await self.despachar() > 0:
+                pass
+        except Exception as e:
+            print(f"Error vaciando el outbox de auditoría: {e}")
+
+    def estado(self):
+        return {
+            "pendientes": self.pendientes,
+            "mas_antiguo": self.mas_antiguo,
+            "lote_max": self.lote,
+            **self.metricas,
+            "ultimo_error": self.ultimo_error
+        }
+
+
+despachador = DespachadorAuditoria(SELA_OUTBOX_LOTE, SELA_OUTBOX_INTERVALO)
+
+
+# --- CADUCIDAD DE ACUERDOS ---
+# Acuerdos caducados por transacción y espera máxima entre comprobaciones
+# (acota el efecto de un cambio de hora del sistema)
+SELA_CADUCIDAD_LOTE = int(os.getenv('SELA_CADUCIDAD_LOTE', 500))
+SELA_CADUCIDAD_ESPERA_MAX = float(os.getenv('SELA_CADUCIDAD_ESPERA_MAX', 30))
+
+
+class PlanificadorCaducidad:
+    """Pasa a 'caducado' los acuerdos activos al cumplirse timestamp + duracion_horas.
+
+    Los vencimientos se guardan en un montículo de mínimos: programar un acuerdo
+    y sacar el siguiente vencido cuestan O(log n), y la tarea duerme hasta el
+    próximo vencimiento en lugar de recorrer los acuerdos periódicamente. Al
+    arrancar se reconstruye con una sola consulta y heapify, en O(n).
+    """
+
+    def __init__(self, lote, espera_max):
+        self.lote = lote
+        self.espera_max = espera_max
+        self.monticulo = []
+        self.despertar = None
+        self.tarea = None
+        self.ultimo_error = None
+        self.metricas = {"caducados": 0, "ya_inactivos": 0, "errores": 0}
+
+    async def cargar(self):
+        self.monticulo = [(vence, acuerdo_id) for acuerdo_id, vence in await almacen.vencimientos_activos()]
+        heapq.heapify(self.monticulo)
+
+    def programar(self, acuerdo):
+        vence = _vencimiento(acuerdo)
+        if vence is None or acuerdo.get("estado", "activo") != "activo":
+            return
+        entrada = (vence, acuerdo["id"])
+        heapq.heappush(self.monticulo, entrada)
+        # Solo hay que despertar la tarea si el nuevo vencimiento es el más próximo
+        if self.monticulo[0] == entrada and self.despertar is not None:
+            self.despertar.set()
+
+    async def caducar_vencidos(self):
+        """Caduca hasta `lote` acuerdos vencidos; devuelve cuántos se procesaron"""
+        ahora = time.time()
+        vencidos = []
+        while self.monticulo and self.monticulo[0][0] <= ahora and len(vencidos) < self.lote:
+            vencidos.append(heapq.heappop(self.monticulo))
+        if not vencidos:
+            return 0
+        try:
+            caducados = await almacen.caducar_acuerdos(vencidos)
+        except Exception:
+            # Vuelven al montículo para reintentarlo en la siguiente vuelta
+            for entrada in vencidos:
+                heapq.heappush(self.monticulo, entrada)
+            raise
+        for _, acuerdo_id in vencidos:
+            contador = contadores.contadores.get(acuerdo_id)
+            if contador is not None:
+                contador.estado = "caducado"
+        self.metricas["caducados"] += len(caducados)
+        # Ya no estaban activos (p. ej. los caducó otra réplica)
+        self.metricas["ya_inactivos"] += len(vencidos) - len(caducados)
+        return len(vencidos)
+
+    async def _bucle(self):
+        while True:
+            self.despertar.clear()
+            espera = self.espera_max
+            try:
+                if await self.caducar_vencidos() >= self.lote:
+                    continue
+                if self.monticulo:
+                    espera = min(max(self.monticulo[0][0] - time.time(), 0), self.espera_max)
+            except Exception as e:
+                self.metricas["errores"] += 1
+                self.ultimo_error = f"{datetime.now().isoformat()}: {e}"
+                print(f"Error caducando acuerdos: {e}")
+            try:
+                await asyncio.wait_for(self.despertar.wait(), espera)
+            except asyncio.TimeoutError:
+                pass
+
+    def iniciar(self):
+        self.despertar = asyncio.Event()
+        self.tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        if self.tarea:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+
+    def estado(self):
+        proximo = self.monticulo[0][0] if self.monticulo else None
+        return {
+            "programados": len(self.monticulo),
+            "proximo_vencimiento": datetime.fromtimestamp(proximo).isoformat() if proximo else None,
+            **self.metricas,
+            "ultimo_error": self.ultimo_error
+        }
+
+
+planificador = PlanificadorCaducidad(SELA_CADUCIDAD_LOTE, SELA_CADUCIDAD_ESPERA_MAX)
+
+
+# --- TRABAJOS DE ANONIMIZACIÓN (/ejecutar) ---
+# Operaciones en cola como máximo (más allá se responde 429) y trabajadores concurrentes
+SELA_TRABAJOS_COLA_MAX = int(os.getenv('SELA_TRABAJOS_COLA_MAX', 1000))
+SELA_TRABAJOS_CONCURRENCIA = int(os.getenv('SELA_TRABAJOS_CONCURRENCIA', 4))
+# Operaciones que un trabajador agrupa por envío y registros como máximo por envío
+# (el LOTE_MAX_REGISTROS de servicio-anonimizacion)
+SELA_TRABAJOS_LOTE = int(os.getenv('SELA_TRABAJOS_LOTE', 50))
+SELA_TRABAJOS_LOTE_REGISTROS = int(os.getenv('SELA_TRABAJOS_LOTE_REGISTROS', 10000))
+SELA_TRABAJOS_TIMEOUT = float(os.getenv('SELA_TRABAJOS_TIMEOUT', 30))
+# Espera máxima de GET /api/v1/operacion/{id}?esperar=N
+SELA_TRABAJOS_ESPERA_MAX = float(os.getenv('SELA_TRABAJOS_ESPERA_MAX', 30))
+# Al apagar, segundos como máximo para terminar las operaciones en cola
+SELA_TRABAJOS_DRENADO = float(os.getenv('SELA_TRABAJOS_DRENADO', 10))
+# Reintentos (espera inicial y máxima, en s) de guardar un resultado que falló al guardarse
+SELA_TRABAJOS_REINTENTO_BASE = float(os.getenv('SELA_TRABAJOS_REINTENTO_BASE', 1))
+SELA_TRABAJOS_REINTENTO_MAX = float(os.getenv('SELA_TRABAJOS_REINTENTO_MAX', 60))
+
+# Parámetros de la operación que se reenvían a /anonimizar/lote
+PARAMETROS_ANONIMIZACION = ("nivel_anonimizacion", "jerarquias", "k", "max_supresion", "algoritmo")
+
+
+class ColaTrabajosLlena(Exception):
+    """No caben más operaciones en la cola de trabajos"""
+
+
+def registros_operacion(datos):
+    # {"registros": [...]} es un lote; cualquier otro objeto, un único registro
+    registros = datos.get("registros")
+    return registros if isinstance(registros, list) else [datos]
+
+
+class Trabajo:
+    __slots__ = ("operacion", "registros", "parametros", "encolado", "terminado")
+
+    def __init__(self, operacion, registros, parametros):
+        self.operacion = operacion
+        self.registros = registros
+        self.parametros = parametros
+        self.encolado = time.monotonic()
+        self.terminado = asyncio.Event()
+
+
+class ColaTrabajos:
+    """Cola acotada de operaciones y trabajadores que las envían a servicio-anonimizacion.
+
+    Cada trabajador saca de la cola hasta `lote` operaciones y agrupa las del
+    mismo acuerdo y parámetros en una sola llamada a /anonimizar/lote; el
+    resultado se reparte después entre las operaciones del grupo. Con k-anonimato
+    cada operación va sola, porque la generalización depende del conjunto.
+    """
+
+    def __init__(self, maximo, concurrencia, lote, max_registros, timeout):
+        self.maximo = maximo
+        self.concurrencia = concurrencia
+        self.lote = lote
+        self.max_registros = max_registros
+        self.timeout = timeout
+        self.cola = None
+        self.aceptando = False
+        self.tareas = []
+        self.tarea_guardado = None
+        self.activos: Dict[str, Trabajo] = {}
+        # Grupos terminados cuyo resultado no se pudo guardar: (trabajos, eventos)
+        self.sin_guardar = []
+        self.reservados = 0
+        self.en_proceso = 0
+        self.espera_cola = HistogramaLatencias()
+        self.latencia = HistogramaLatencias()
+        self.metricas = {"aceptadas": 0, "rechazadas": 0, "completadas": 0, "errores": 0,
+                         "envios": 0, "registros_enviados": 0}
+
+    async def encolar(self, operacion, registros, parametros):
+        """Registra la operación en estado en_progreso y la pone en la cola"""
+        # Las plazas se reservan antes de guardar para no aceptar más de las que caben
+        if not self.aceptando or self.cola.qsize() + self.reservados >= self.maximo:
+            self.metricas["rechazadas"] += 1
+            raise ColaTrabajosLlena()
+        self.reservados += 1
+        try:
+            trabajo = Trabajo(operacion, registros, parametros)
+            await almacen.guardar_operacion(operacion)
+        finally:
+            self.reservados -= 1
+        if not self.aceptando:
+            # El servicio se detuvo mientras se guardaba: la operación no llega a la cola
+            await self._fallar([trabajo], "Servicio detenido antes de completar la operación")
+            return trabajo
+        self.activos[operacion["id"]] = trabajo
+        self.cola.put_nowait(trabajo)
+        self.metricas["aceptadas"] += 1
+        return trabajo
+
+    def _agrupar(self, trabajos):
+        grupos = {}
+        for trabajo in trabajos:
+            if trabajo.parametros.get("nivel_anonimizacion") == "k_anonimato":
+                clave = trabajo.operacion["id"]
+            else:
+                clave = (trabajo.operacion["acuerdo_id"], json.dumps(trabajo.parametros, sort_keys=True))
+            grupos.setdefault(clave, []).append(trabajo)
+        for grupo in grupos.values():
+            actual, registros = [], 0
+            for trabajo in grupo:
+                if actual and registros + len(trabajo.registros) > self.max_registros:
+                    yield actual
+                    actual, registros = [], 0
+                actual.append(trabajo)
+                registros += len(trabajo.registros)
+            yield actual
+
+    async def _procesar(self, grupo):
+        inicio = time.monotonic()
+        for trabajo in grupo:
+            self.espera_cola.observar((inicio - trabajo.encolado) * 1000)
+        registros = [registro for trabajo in grupo for registro in trabajo.registros]
+        # La cuota ya está reservada: anonimización la consume con este id en lugar
+        # de volver a contarla, y devuelve la de los registros que no procese
+        reserva = contadores.agrupar_reservas([trabajo.operacion["id"] for trabajo in grupo])
+        try:
+            respuesta = await cliente_http.post(
+                f"{ANONIMIZACION_SERVICE_URL}/anonimizar/lote",
+                json={"acuerdo_id": grupo[0].operacion["acuerdo_id"], "registros": registros,
+                      "reserva": reserva, **grupo[0].parametros},
+                timeout=self.timeout
+            )
+            cuerpo = respuesta.json()
+            if respuesta.status_code != 200:
+                raise RuntimeError(cuerpo.get("error") or cuerpo.get("mensaje") or f"status {respuesta.status_code}")
+        except Exception as e:
+            fallo = {"error": f"servicio-anonimizacion: {str(e) or type(e).__name__}"}
+            await self._terminar(grupo, [("error", fallo)] * len(grupo))
+            return
+        finally:
+            # Si anonimización no llegó a consumirla, la reserva se devuelve
+            if reserva is not None:
+                await contadores.cancelar_reserva(reserva)
+            # Enviados o no, los datos sin anonimizar no se conservan
+            for trabajo in grupo:
+                trabajo.registros = None
+        self.metricas["envios"] += 1
+        self.metricas["registros_enviados"] += len(registros)
+
+        datos = cuerpo.get("datos_anonimizados", [])
+        errores = {error["indice"]: error["error"] for error in cuerpo.get("errores", [])}
+        resultados = []
+        inicio_grupo = 0
+        for trabajo in grupo:
+            fin = inicio_grupo + trabajo.operacion["registros"]
+            resultado = {
+                "operacion_anonimizacion": cuerpo.get("operacion_id"),
+                "registros_procesados": sum(1 for dato in datos[inicio_grupo:fin] if dato is not None),
+                "errores": [{"indice": i - inicio_grupo, "error": errores[i]}
+                            for i in range(inicio_grupo, fin) if i in errores],
+                "datos_anonimizados": datos[inicio_grupo:fin]
+            }
+            if "generalizacion" in cuerpo:
+                resultado["generalizacion"] = cuerpo["generalizacion"]
+            resultados.append(("completada" if resultado["registros_procesados"] else "error", resultado))
+            inicio_grupo = fin
+        await self._terminar(grupo, resultados)
+
+    async def _terminar(self, grupo, resultados):
+        """Guarda el estado final de un grupo en una transacción y despierta a quien espera"""
+        ahora = time.monotonic()
+        eventos = []
+        for trabajo, (estado, resultado) in zip(grupo, resultados):
+            operacion = trabajo.operacion
+            operacion.update(
+                estado=estado, resultado=resultado, fecha_fin=datetime.now().isoformat(),
+                latencia_ms=round((ahora - trabajo.encolado) * 1000, 3)
+            )
+            eventos.append(evento_auditoria(
+                "EJECUCION_OPERACION", operacion["acuerdo_id"],
+                resultado="exito" if estado == "completada" else "error",
+                id_operacion=operacion["id"], tipo=operacion.get("operacion"),
+                registros=operacion["registros"], registros_procesados=resultado.get("registros_procesados", 0)
+            ))
+        try:
+            await almacen.actualizar_operaciones([trabajo.operacion for trabajo in grupo], "en_progreso", eventos)
+            guardado = True
+        except Exception as e:
+            # La operación sigue en memoria, y consultable, hasta que un reintento la guarde
+            print(f"Error guardando el resultado de {len(grupo)} operaciones: {e}")
+            self.sin_guardar.append((grupo, eventos))
+            guardado = False
+        for trabajo, (estado, _) in zip(grupo, resultados):
+            self.latencia.observar((ahora - trabajo.encolado) * 1000, estado == "error")
+            self.metricas["completadas" if estado == "completada" else "errores"] += 1
+            if guardado:
+                self.activos.pop(trabajo.operacion["id"], None)
+            trabajo.terminado.set()
+
+    async def _guardar_pendientes(self):
+        """Reintenta guardar los resultados pendientes en orden; True si no queda ninguno"""
+        while self.sin_guardar:
+            grupo, eventos = self.sin_guardar[0]
+            try:
+                await almacen.actualizar_operaciones([trabajo.operacion for trabajo in grupo], "en_progreso", eventos)
+            except Exception as e:
+                print(f"Error reintentando guardar {len(grupo)} operaciones: {e}")
+                return False
+            self.sin_guardar.pop(0)
+            for trabajo in grupo:
+                self.activos.pop(trabajo.operacion["id"], None)
+        return True
+
+    async def _reintentar_guardado(self):
+        espera = SELA_TRABAJOS_REINTENTO_BASE
+        while True:
+            await asyncio.sleep(espera)
+            if await self._guardar_pendientes():
+                espera = SELA_TRABAJOS_REINTENTO_BASE
+            else:
+                espera = min(espera * 2, SELA_TRABAJOS_REINTENTO_MAX)
+
+    async def _fallar(self, grupo, error):
+        """Termina con error las operaciones del grupo aún sin resultado y devuelve su cuota"""
+        pendientes = [trabajo for trabajo in grupo if not trabajo.terminado.is_set()]
+        for trabajo in pendientes:
+            await contadores.cancelar_reserva(trabajo.operacion["id"])
+        if pendientes:
+            await self._terminar(pendientes, [("error", {"error": error})] * len(pendientes))
+
+    async def _trabajador(self):
+        cola = self.cola
+        while True:
+            trabajos = [await cola.get()]
+            while len(trabajos) < self.lote and not cola.empty():
+                trabajos.append(cola.get_nowait())
+            self.en_proceso += len(trabajos)
+            try:
+                for grupo in self._agrupar(trabajos):
+                    # Un grupo que falla no deja sin procesar a los demás del lote
+                    try:
+                        await self._procesar(grupo)
+                    except Exception as e:
+                        print(f"Error procesando {len(grupo)} operaciones: {e}")
+                        await self._fallar(grupo, f"Error procesando la operación: {str(e) or type(e).__name__}")
+            except Exception as e:
+                print(f"Error en el trabajador de operaciones: {e}")
+            finally:
+                self.en_proceso -= len(trabajos)
+                for _ in trabajos:
+                    cola.task_done()
+
+    def iniciar(self):
+        self.cola = asyncio.Queue(self.maximo)
+        self.aceptando = True
+        self.tareas = [asyncio.create_task(self._trabajador()) for _ in range(self.concurrencia)]
+        self.tarea_guardado = asyncio.create_task(self._reintentar_guardado())
+
+    async def detener(self, drenado):
+        if not self.aceptando:
+            return
+        # No se aceptan más operaciones; las de la cola tienen `drenado` segundos
+        self.aceptando = False
+        try:
+            await asyncio.wait_for(self.cola.join(), drenado)
+        except asyncio.TimeoutError:
+            pass
+        for tarea in self.tareas:
+            tarea.cancel()
+        await asyncio.gather(*self.tareas, return_exceptions=True)
+        self.tareas = []
+        await self._fallar(list(self.activos.values()), "Servicio detenido antes de completar la operación")
+        self.tarea_guardado.cancel()
+        await asyncio.gather(self.tarea_guardado, return_exceptions=True)
+        self.tarea_guardado = None
+        # Último intento: lo que siga sin guardar se pierde al apagar
+        if not await self._guardar_pendientes():
+            perdidas = sum(len(grupo) for grupo, _ in self.sin_guardar)
+            print(f"Se pierde el resultado de {perdidas} operaciones sin guardar")
+
+    @staticmethod
+    def _percentiles(histograma):
+        return {clave: valor for clave, valor in histograma.resumen().items() if clave.endswith("_ms")}
+
+    def estado(self):
+        return {
+            "en_cola": self.cola.qsize() if self.cola is not None else 0,
+            "cola_max": self.maximo,
+            "en_proceso": self.en_proceso,
+            "sin_guardar": sum(len(grupo) for grupo, _ in self.sin_guardar),
+            "concurrencia": self.concurrencia,
+            **self.metricas,
+            "registros_por_envio": (
+                round(self.metricas["registros_enviados"] / self.metricas["envios"], 1)
+                if self.metricas["envios"] else None
+            ),
+            "espera_en_cola": self._percentiles(self.espera_cola),
+            "latencia_total": self._percentiles(self.latencia)
+        }
+
+
+trabajos = ColaTrabajos(SELA_TRABAJOS_COLA_MAX, SELA_TRABAJOS_CONCURRENCIA, SELA_TRABAJOS_LOTE,
+                        SELA_TRABAJOS_LOTE_REGISTROS, SELA_TRABAJOS_TIMEOUT)
+
+
+@app.on_event("startup")
+async def startup_event():
+    global cliente_http, tarea_estadisticas
+    cliente_http = crear_cliente_http()
+    almacen.inicializar()
+    await cargar_estadisticas()
+    contadores.iniciar()
+    await planificador.cargar()
+    planificador.iniciar()
+    trabajos.iniciar()
+    if almacen.backend.nombre == "postgres" and SELA_ESTADISTICAS_RESINCRONIZAR > 0:
+        tarea_estadisticas = asyncio.create_task(_resincronizar_estadisticas())
+    monitor.iniciar()
+    despachador.iniciar()
+    print(f"Almacenamiento de acuerdos: {almacen.backend.nombre}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Orden inverso al arranque: el despachador necesita almacenamiento y cliente HTTP,
+    # y las operaciones que terminan al apagar dejan eventos en el outbox
+    await trabajos.detener(SELA_TRABAJOS_DRENADO)
+    await despachador.detener(SELA_OUTBOX_DRENADO)
+    await monitor.detener()
+    await planificador.detener()
+    if tarea_estadisticas:
+        tarea_estadisticas.cancel()
+    await contadores.detener()
+    almacen.cerrar()
+    await cliente_http.aclose()
 
 # Modelos
 class PartesAcuerdo(BaseModel):
@@ -80,7 +1942,7 @@ async def infraestructura():
 async def demo_tribunal():
     # Sumamos los contadores de cada acuerdo.  
     # Solo subirá cuando el servicio 8001 llame a /incrementar.
-    total_usos_datos = sum(acc.get("operaciones_ejecutadas", 0) for acc in acuerdos_db.values())
+    total_usos_datos = estadisticas.usos
     
     return {
         "titulo": "DEMO SISTEMA SeLA - TFM",
@@ -92,12 +1954,15 @@ async def demo_tribunal():
             "Servicio Auditoría (Trazabilidad RGPD)"
         ],
         "estado_actual": {
-            "acuerdos_activos": len(acuerdos_db),
-            "operaciones_ejecutadas": len(operaciones_db),
+            "acuerdos_activos": estadisticas.acuerdos_por_estado["activo"],
+            "operaciones_ejecutadas": estadisticas.total_operaciones,
             "servicio": "operacional"
         }
     }
 
+# Campos del acuerdo que genera el servidor: el cliente no puede fijarlos al crearlo
+CAMPOS_SERVIDOR_ACUERDO = ("id", "timestamp", "estado", "operaciones_ejecutadas", "hash")
+
 @app.post("/api/v1/acuerdo/crear")
 async def crear_acuerdo(payload: dict): # Usamos payload para evitar conflictos con la palabra 'request'
     try:
@@ -131,26 +1996,18 @@ async def crear_acuerdo(payload: dict): # Usamos payload para evitar conflictos
             "estado": "activo",
             "operaciones_ejecutadas": 0,  # <--- INICIALIZAMOS A CERO SIEMPRE
             "hash": hashlib.sha256(acuerdo_id.encode()).hexdigest()[:16],
-            **payload # Esto mete todos los datos que enviaste en el acuerdo
+            # Esto mete todos los datos que enviaste en el acuerdo, salvo los que fija el servidor
+            **{k: v for k, v in payload.items() if k not in CAMPOS_SERVIDOR_ACUERDO}
         }
         
-        # --- NUEVO: ENVIAR A AUDITORÍA ---
-        try:
-            async with httpx.AsyncClient() as client:
-                await client.post(
-                    "http://servicio-auditoria:8002/registrar", # Nombre del servicio en Docker
-                    json={
-                        "operacion": "CREACION_ACUERDO",
-                        "detalles": f"Nuevo acuerdo creado con ID {acuerdo_id}",
-                        "base_legal": nuevo_acuerdo["base_legal"]
-                    }
-                )
-        except Exception as e:
-            print(f"Error enviando a auditoría: {e}")
-        # ---------------------------------
-
-        # Guardamos en tu base de datos en memoria (o donde lo tengas)
-        acuerdos_db[acuerdo_id] = nuevo_acuerdo
+        # Guardamos en el almacenamiento configurado (memoria, SQLite o PostgreSQL)
+        # junto con el evento de auditoría, que el despachador del outbox enviará
+        evento = evento_auditoria(
+            "CREACION_ACUERDO", acuerdo_id,
+            detalles=f"Nuevo acuerdo creado con ID {acuerdo_id}",
+            base_legal=nuevo_acuerdo["base_legal"]
+        )
+        await almacen.guardar_acuerdo(nuevo_acuerdo, [evento])
         
         return {
             "status": "success",
@@ -183,83 +2040,150 @@ async def crear_acuerdo(payload: dict): # Usamos payload para evitar conflictos
 
 @app.get("/api/v1/acuerdo/{acuerdo_id}/estado")
 async def estado_acuerdo(acuerdo_id: str):
-    if acuerdo_id in acuerdos_db:
-        return acuerdos_db[acuerdo_id]
+    acuerdo = await almacen.obtener_acuerdo(acuerdo_id)
+    if acuerdo is not None:
+        return contadores.superponer(acuerdo)
     raise HTTPException(status_code=404, detail="Acuerdo no encontrado")
 
 @app.post("/api/v1/acuerdo/{acuerdo_id}/ejecutar")
 async def ejecutar_operacion(acuerdo_id: str, operacion: OperacionRequest):
-    if acuerdo_id not in acuerdos_db:
-        raise HTTPException(status_code=404, detail="Acuerdo no encontrado")
-    
+    registros = registros_operacion(operacion.datos)
+    if not registros:
+        raise HTTPException(status_code=400, detail="'datos.registros' no puede estar vacío")
+    if len(registros) > SELA_TRABAJOS_LOTE_REGISTROS:
+        raise HTTPException(status_code=413, detail=f"Máximo {SELA_TRABAJOS_LOTE_REGISTROS} registros por operación")
+
+    # Admisión: el acuerdo debe estar activo, vigente y con cuota para todos los registros,
+    # que se reservan ya para que las operaciones en cola no superen volumen_maximo
     operacion_id = str(uuid.uuid4())
+    try:
+        if await contadores.reservar(acuerdo_id, len(registros), operacion_id) is None:
+            raise HTTPException(status_code=404, detail="Acuerdo no encontrado")
+    except UsoRechazado as e:
+        raise HTTPException(status_code=403, detail=e.detalle())
+    
     operacion_data = {
         "id": operacion_id,
         "acuerdo_id": acuerdo_id,
         "operacion": operacion.operacion,
-        "datos": operacion.datos,
+        # Los registros originales no se guardan: solo viajan en memoria hasta el envío
+        "registros": len(registros),
         "parametros": operacion.parametros,
         "fecha_ejecucion": datetime.now().isoformat(),
         "estado": "en_progreso"
     }
     
-    operaciones_db[operacion_id] = operacion_data
+    parametros = {clave: operacion.parametros[clave] for clave in PARAMETROS_ANONIMIZACION
+                  if clave in operacion.parametros}
+    try:
+        await trabajos.encolar(operacion_data, registros, parametros)
+    except ColaTrabajosLlena:
+        await contadores.cancelar_reserva(operacion_id)
+        raise HTTPException(status_code=429, detail="Cola de operaciones llena", headers={"Retry-After": "1"})
+    except Exception:
+        await contadores.cancelar_reserva(operacion_id)
+        raise
     
-    # Simular procesamiento asíncrono
+    # El procesamiento es asíncrono: el resultado se consulta en /api/v1/operacion/{id}
     return {
         "operacion": operacion_data,
         "mensaje": "Operación aceptada para procesamiento",
-        "proximo_paso": "Datos enviados a anonimización"
+        "proximo_paso": f"Consultar GET /api/v1/operacion/{operacion_id}?esperar=30"
     }
 
+@app.get("/api/v1/operacion/{operacion_id}")
+async def obtener_operacion(operacion_id: str, esperar: float = Query(0, ge=0, le=SELA_TRABAJOS_ESPERA_MAX)):
+    """
+    Estado de una operación de /ejecutar. Con `esperar` (segundos), si sigue
+    en_progreso la respuesta espera a que termine o a que pase ese tiempo.
+    """
+    limite = time.monotonic() + esperar
+    while True:
+        trabajo = trabajos.activos.get(operacion_id)
+        if trabajo is not None:
+            if esperar:
+                try:
+                    await asyncio.wait_for(trabajo.terminado.wait(), max(limite - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    pass
+            return {"operacion": trabajo.operacion}
+        operacion = await almacen.obtener_operacion(operacion_id)
+        if operacion is None:
+            raise HTTPException(status_code=404, detail="Operación no encontrada")
+        restante = limite - time.monotonic()
+        # Operación de otra réplica: se consulta el almacenamiento hasta que termine
+        if operacion.get("estado") != "en_progreso" or restante <= 0:
+            return {"operacion": operacion}
+        await asyncio.sleep(min(0.5, restante))
+
 # NUEVOS ENDPOINTS PARA COMPLETAR PRUEBAS TFM
 
 @app.get("/api/v1/acuerdos")
 async def listar_acuerdos():
+    acuerdos = [contadores.superponer(a) for a in await almacen.listar_acuerdos()]
     return {
-        "total": len(acuerdos_db),
-        "acuerdos": list(acuerdos_db.values())
+        "total": len(acuerdos),
+        "acuerdos": acuerdos
     }
 
 @app.get("/api/v1/acuerdo/{acuerdo_id}")
 async def obtener_acuerdo(acuerdo_id: str):
-    if acuerdo_id in acuerdos_db:
-        return {"acuerdo": acuerdos_db[acuerdo_id]}
+    acuerdo = await almacen.obtener_acuerdo(acuerdo_id)
+    if acuerdo is not None:
+        return {"acuerdo": contadores.superponer(acuerdo)}
     raise HTTPException(status_code=404, detail="Acuerdo no encontrado")
 
 @app.post("/api/v1/acuerdo/{acuerdo_id}/incrementar")
-async def incrementar_operacion(acuerdo_id: str):
-    # Verificamos si el ID existe en tu diccionario global
-    if acuerdo_id in acuerdos_db:
-        # Accedemos al diccionario interno del acuerdo
-        acuerdo = acuerdos_db[acuerdo_id]
-        
-        # Incrementamos el contador (asegurándonos de que existe)
-        actual = acuerdo.get("operaciones_ejecutadas", 0)
-        acuerdos_db[acuerdo_id]["operaciones_ejecutadas"] = actual + 1
-
-        # 2. NUEVO: Creamos un registro de evidencia en operaciones_db
-        # Esto es lo que hará que len(operaciones_db) deje de ser 0
-        id_operacion = str(uuid.uuid4())
-        operaciones_db[id_operacion] = {
-            "acuerdo_id": acuerdo_id,
-            "timestamp": datetime.now().isoformat(),
-            "tipo": "ANONIMIZACION"
-        }
+async def incrementar_operacion(acuerdo_id: str, cantidad: int = Query(1, ge=1), reserva: Optional[str] = None):
+    # servicio-anonimizacion llama aquí ANTES de anonimizar: un 403 le impide procesar los datos
+    # cantidad permite registrar un lote completo con una sola llamada
+    if reserva and contadores.consumir_reserva(reserva, acuerdo_id, cantidad):
+        # Lote enviado por /ejecutar: la cuota ya se consumió al aceptar la operación
+        return {"status": "success", "acuerdo": acuerdo_id, "reservado": True,
+                "nuevo_total": contadores.contadores[acuerdo_id].total}
+    # Registro de evidencia en operaciones, que se guarda junto con el incremento
+    evidencia = {
+        "id": str(uuid.uuid4()),
+        "acuerdo_id": acuerdo_id,
+        "timestamp": datetime.now().isoformat(),
+        "tipo": "ANONIMIZACION",
+        "cantidad": cantidad
+    }
+    # Se admite el lote entero o nada: con cuota o vigencia agotadas se rechaza (403)
+    try:
+        nuevo_total = await contadores.incrementar(acuerdo_id, cantidad, evidencia)
+    except UsoRechazado as e:
+        raise HTTPException(status_code=403, detail=e.detalle())
+    if nuevo_total is not None:
+        actual = nuevo_total - cantidad
         
         # Log para la terminal de la demo
-        print(f"📈 [CONTADOR] Acuerdo {acuerdo_id}: {actual} -> {actual + 1}")
-        print(f"🗒️ [AUDITORIA] Nueva entrada en operaciones_db. Total: {len(operaciones_db)}")
+        print(f"📈 [CONTADOR] Acuerdo {acuerdo_id}: {actual} -> {nuevo_total}")
         
         return {
             "status": "success", 
             "acuerdo": acuerdo_id,
-            "nuevo_total": acuerdos_db[acuerdo_id]["operaciones_ejecutadas"]
+            "nuevo_total": nuevo_total
         }
     
     # Si llegamos aquí, el ID no existe
     raise HTTPException(status_code=404, detail=f"Acuerdo {acuerdo_id} no encontrado")
 
+@app.post("/api/v1/acuerdo/{acuerdo_id}/liberar")
+async def liberar_uso(acuerdo_id: str, cantidad: int = Query(1, ge=1)):
+    """Devuelve la cuota consumida por registros que finalmente no se anonimizaron"""
+    evidencia = {
+        "id": str(uuid.uuid4()),
+        "acuerdo_id": acuerdo_id,
+        "timestamp": datetime.now().isoformat(),
+        "tipo": "LIBERACION",
+        "cantidad": cantidad
+    }
+    nuevo_total = await contadores.liberar(acuerdo_id, cantidad, evidencia)
+    if nuevo_total is None:
+        raise HTTPException(status_code=404, detail=f"Acuerdo {acuerdo_id} no encontrado")
+    return {"status": "success", "acuerdo": acuerdo_id, "nuevo_total": nuevo_total}
+
 @app.post("/api/v1/rgpd/validar")
 async def validar_rgpd(validacion: dict):
     return {
@@ -303,38 +2227,21 @@ async def minimizar_datos(minimizacion: dict):
 @app.get("/api/v1/operaciones/estado")
 async def estado_operaciones():
     return {
-        "total_operaciones": len(operaciones_db),
-        "operaciones_activas": sum(1 for op in operaciones_db.values() if op.get("estado") == "en_progreso"),
-        "operaciones_completadas": sum(1 for op in operaciones_db.values() if op.get("estado") == "completada"),
-        "operaciones_por_tipo": {},
-        "ultimas_operaciones": list(operaciones_db.values())[-5:] if operaciones_db else []
+        "total_operaciones": estadisticas.total_operaciones,
+        "operaciones_activas": estadisticas.operaciones_por_estado["en_progreso"],
+        "operaciones_completadas": estadisticas.operaciones_por_estado["completada"],
+        "operaciones_por_tipo": _sin_ceros(estadisticas.operaciones_por_tipo),
+        "ultimas_operaciones": list(estadisticas.ultimas)
     }
 
 @app.get("/api/v1/health/detallado")
 async def health_detallado():
+    # Servicios externos: último resultado del monitor en segundo plano, sin esperar a la red
     servicios = {
         "sela": {"estado": "ok", "puerto": 8000},
-        "anonimizacion": {"estado": "checking", "puerto": 8001},
-        "auditoria": {"estado": "checking", "puerto": 8002}
+        **monitor.instantanea()
     }
     
-    # Verificar servicios externos
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get("http://servicio-anonimizacion:8001/health", timeout=2.0)
-            if response.status_code == 200:
-                servicios["anonimizacion"]["estado"] = "ok"
-    except:
-        servicios["anonimizacion"]["estado"] = "error"
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get("http://servicio-auditoria:8002/health", timeout=2.0)
-            if response.status_code == 200:
-                servicios["auditoria"]["estado"] = "ok"
-    except:
-        servicios["auditoria"]["estado"] = "error"
-    
     estado_general = "operacional" if all(s["estado"] == "ok" for s in servicios.values()) else "degradado"
     
     return {
@@ -343,33 +2250,38 @@ async def health_detallado():
         "version": "1.0.0",
         "servicios": servicios,
         "recursos": {
-            "acuerdos_activos": len(acuerdos_db),
-            "operaciones_pendientes": sum(1 for op in operaciones_db.values() if op.get("estado") == "en_progreso")
-        }
+            "acuerdos_activos": estadisticas.acuerdos_por_estado["activo"],
+            "operaciones_pendientes": estadisticas.operaciones_por_estado["en_progreso"]
+        },
+        "almacenamiento": almacen.estado(),
+        "contadores_uso": contadores.estado(),
+        "caducidad": planificador.estado(),
+        "trabajos": trabajos.estado(),
+        "outbox_auditoria": despachador.estado()
     }
 
 @app.get("/api/v1/estadisticas")
 async def obtener_estadisticas():
     return {
         "acuerdos": {
-            "total": len(acuerdos_db),
-            "activos": len([a for a in acuerdos_db.values() if a.get("estado") == "activo"]),
-            "por_tipo_datos": {},
-            "por_finalidad": {}
+            "total": estadisticas.total_acuerdos,
+            "activos": estadisticas.acuerdos_por_estado["activo"],
+            "por_estado": _sin_ceros(estadisticas.acuerdos_por_estado),
+            "por_tipo_datos": _sin_ceros(estadisticas.acuerdos_por_tipo_datos),
+            "por_finalidad": _sin_ceros(estadisticas.acuerdos_por_finalidad)
         },
         "operaciones": {
-            "total": len(operaciones_db),
-            "exitosas": sum(1 for op in operaciones_db.values() if op.get("estado") == "completada"),
-            "fallidas": sum(1 for op in operaciones_db.values() if op.get("estado") == "error"),
-            "en_progreso": sum(1 for op in operaciones_db.values() if op.get("estado") == "en_progreso")
-        },
-        "rendimiento": {
-            "uptime": "99.9%",
-            "tiempo_respuesta_promedio_ms": 45,
-            "disponibilidad_servicios": "100%"
+            "total": estadisticas.total_operaciones,
+            "exitosas": estadisticas.operaciones_por_estado["completada"],
+            "fallidas": estadisticas.operaciones_por_estado["error"],
+            "en_progreso": estadisticas.operaciones_por_estado["en_progreso"],
+            "por_tipo": _sin_ceros(estadisticas.operaciones_por_tipo),
+            "usos_datos": estadisticas.usos
         },
+        # Medido por el middleware sobre todas las peticiones atendidas
+        "rendimiento": resumen_rendimiento(),
         "auditoria": {
-            "operaciones_auditadas": len(operaciones_db),
+            "operaciones_auditadas": estadisticas.total_operaciones,
             "cumplimiento_rgpd": "100%"
         }
     }
@@ -418,6 +2330,11 @@ async def documentacion_api():
                 "descripcion": "Ejecutar operación bajo acuerdo",
                 "body": "OperacionRequest"
             },
+            {
+                "ruta": "/api/v1/operacion/{id}",
+                "metodo": "GET",
+                "descripcion": "Estado y resultado de una operación (esperar=N para long-polling)"
+            },
             {
                 "ruta": "/api/v1/acuerdos",
                 "metodo": "GET",
@@ -0,0 +1,29 @@
+import os
+import sys
+
+# Almacenamiento en memoria y dependencias inalcanzables: las pruebas no salen del proceso
+os.environ.setdefault("SELA_ALMACENAMIENTO", "memoria")
+os.environ.setdefault("AUDITORIA_SERVICE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("ANONIMIZACION_SERVICE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("SELA_OUTBOX_BACKOFF_BASE", "100")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as sela
+
+
+@pytest.fixture(scope="session")
+def cliente():
+    with TestClient(sela.app) as cliente:
+        yield cliente
+
+
+@pytest.fixture
+def crear_acuerdo(cliente):
+    """Crea un acuerdo activo y devuelve su id"""
+    def crear(**campos):
+        respuesta = cliente.post("/api/v1/acuerdo/crear", json={"base_legal": "contrato", "nombre": "prueba", **campos})
+        return respuesta.json()["acuerdo"]["id"]
+    return crear
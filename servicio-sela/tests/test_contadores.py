@@ -0,0 +1,69 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as sela
+
+
+def incrementar(cliente, acuerdo_id, cantidad, **params):
+    return cliente.post(f"/api/v1/acuerdo/{acuerdo_id}/incrementar", params={"cantidad": cantidad, **params})
+
+
+def test_lote_que_supera_volumen_maximo_se_rechaza_entero(cliente, crear_acuerdo):
+    acuerdo_id = crear_acuerdo(volumen_maximo=3)
+    assert incrementar(cliente, acuerdo_id, 2).json()["nuevo_total"] == 2
+
+    respuesta = incrementar(cliente, acuerdo_id, 2)
+    assert respuesta.status_code == 403
+    assert respuesta.json()["detail"]["motivo"] == "cuota_agotada"
+    assert respuesta.json()["detail"]["restante"] == 1
+
+    assert incrementar(cliente, acuerdo_id, 1).json()["nuevo_total"] == 3
+
+
+def test_liberar_devuelve_cuota_sin_bajar_de_cero(cliente, crear_acuerdo):
+    acuerdo_id = crear_acuerdo(volumen_maximo=2)
+    incrementar(cliente, acuerdo_id, 2)
+    assert cliente.post(f"/api/v1/acuerdo/{acuerdo_id}/liberar", params={"cantidad": 1}).json()["nuevo_total"] == 1
+    assert incrementar(cliente, acuerdo_id, 1).status_code == 200
+    assert cliente.post(f"/api/v1/acuerdo/{acuerdo_id}/liberar", params={"cantidad": 10}).json()["nuevo_total"] == 0
+
+
+def test_reserva_se_consume_sin_contar_dos_veces(cliente, crear_acuerdo):
+    acuerdo_id = crear_acuerdo(volumen_maximo=4)
+    cliente.portal.call(sela.contadores.reservar, acuerdo_id, 3, "reserva-1")
+
+    respuesta = incrementar(cliente, acuerdo_id, 2, reserva="reserva-1").json()
+    assert respuesta["reservado"] is True
+    assert respuesta["nuevo_total"] == 3
+
+    # Solo queda 1 reservado: un lote de 2 se cuenta aparte y no cabe en la cuota
+    assert incrementar(cliente, acuerdo_id, 2, reserva="reserva-1").status_code == 403
+
+    # Lo reservado y no consumido vuelve al cancelar la reserva
+    cliente.portal.call(sela.contadores.cancelar_reserva, "reserva-1")
+    assert sela.contadores.contadores[acuerdo_id].total == 2
+
+
+def test_reserva_de_otro_acuerdo_no_se_consume(cliente, crear_acuerdo):
+    acuerdo_id = crear_acuerdo(volumen_maximo=5)
+    otro_id = crear_acuerdo(volumen_maximo=5)
+    cliente.portal.call(sela.contadores.reservar, acuerdo_id, 2, "reserva-2")
+    assert not sela.contadores.consumir_reserva("reserva-2", otro_id, 1)
+    cliente.portal.call(sela.contadores.cancelar_reserva, "reserva-2")
+
+
+def test_acuerdo_caducado_rechaza_uso_antes_que_la_cuota():
+    creado = (datetime.now() - timedelta(hours=2)).isoformat()
+    contador = sela.ContadorAcuerdo({"volumen_maximo": 0, "duracion_horas": 1, "timestamp": creado})
+    with pytest.raises(sela.UsoRechazado) as error:
+        contador.comprobar(1, time.time())
+    assert error.value.motivo == "caducado"
+
+
+def test_acuerdo_inactivo_rechaza_uso():
+    contador = sela.ContadorAcuerdo({"volumen_maximo": 10, "estado": "revocado"})
+    with pytest.raises(sela.UsoRechazado) as error:
+        contador.comprobar(1, time.time())
+    assert error.value.motivo == "inactivo"
@@ -0,0 +1,106 @@
+import json
+
+import httpx
+import pytest
+
+import app as sela
+
+
+class AuditoriaFalsa:
+    """Servicio de auditoría simulado: guarda los lotes recibidos y descarta duplicados"""
+
+    def __init__(self):
+        self.lotes = []
+        self.registrados = set()
+        self.fallar = False
+
+    def __call__(self, peticion):
+        if self.fallar:
+            return httpx.Response(503, json={"detail": "no disponible"})
+        eventos = json.loads(peticion.content)["eventos"]
+        self.lotes.append(eventos)
+        ids = [evento["operacion_id"] for evento in eventos]
+        duplicados = sum(1 for id_evento in ids if id_evento in self.registrados)
+        self.registrados.update(ids)
+        return httpx.Response(200, json={"registrados": len(ids) - duplicados, "duplicados": duplicados})
+
+
+@pytest.fixture
+def outbox(cliente, monkeypatch):
+    """Outbox en memoria aislado, con el despachador de la aplicación parado"""
+    cliente.portal.call(sela.despachador.detener, 0)
+    auditoria = AuditoriaFalsa()
+    monkeypatch.setattr(sela, "almacen", sela.Almacenamiento(sela.AlmacenMemoria()))
+    monkeypatch.setattr(sela, "cliente_http", httpx.AsyncClient(transport=httpx.MockTransport(auditoria)))
+    yield auditoria
+    monkeypatch.undo()
+    cliente.portal.call(sela.despachador.iniciar)
+
+
+def encolar(n):
+    eventos = [sela.evento_auditoria("prueba", indice=i) for i in range(n)]
+    sela.almacen.backend._encolar_eventos(eventos)
+    return eventos
+
+
+def test_eventos_salen_del_outbox_solo_al_confirmar_el_lote(cliente, outbox):
+    eventos = encolar(5)
+    despachador = sela.DespachadorAuditoria(lote=2, intervalo=1)
+
+    outbox.fallar = True
+    assert cliente.portal.call(despachador.despachar) == 0
+    assert len(sela.almacen.backend.outbox) == 5
+
+    outbox.fallar = False
+    for entrada in sela.almacen.backend.outbox.values():
+        entrada[2] = 0.0
+    enviados = [cliente.portal.call(despachador.despachar) for _ in range(4)]
+    assert enviados == [2, 2, 1, 0]
+    assert not sela.almacen.backend.outbox
+    # Los eventos llegan en el orden en que se encolaron
+    assert [e["operacion_id"] for lote in outbox.lotes for e in lote] == [e["operacion_id"] for e in eventos]
+
+
+def test_fallo_aplaza_el_lote_con_backoff_exponencial(cliente, outbox):
+    encolar(1)
+    despachador = sela.DespachadorAuditoria(lote=10, intervalo=1)
+    outbox.fallar = True
+
+    base = sela.SELA_OUTBOX_BACKOFF_BASE
+    for intento in (1, 2, 3):
+        assert cliente.portal.call(despachador.despachar) == 0
+        evento, intentos, siguiente = next(iter(sela.almacen.backend.outbox.values()))
+        assert intentos == intento
+        espera = min(base * 2 ** (intento - 1), sela.SELA_OUTBOX_BACKOFF_MAX)
+        assert espera / 2 <= despachador.pausa <= espera
+        # Mientras no vence el backoff el lote no se vuelve a intentar
+        assert cliente.portal.call(despachador.despachar) == 0
+        assert next(iter(sela.almacen.backend.outbox.values()))[1] == intento
+        sela.almacen.backend.outbox[evento["operacion_id"]][2] = 0.0
+    assert despachador.metricas["fallos"] == 3
+    assert despachador.ultimo_error
+
+
+def test_reintento_reenvia_los_mismos_operacion_id(cliente, outbox, monkeypatch):
+    eventos = encolar(3)
+    despachador = sela.DespachadorAuditoria(lote=10, intervalo=1)
+
+    # Auditoría registra el lote pero la respuesta se pierde por el camino
+    def respuesta_perdida(peticion):
+        outbox(peticion)
+        raise httpx.ReadTimeout("respuesta perdida", request=peticion)
+
+    monkeypatch.setattr(sela, "cliente_http", httpx.AsyncClient(transport=httpx.MockTransport(respuesta_perdida)))
+    assert cliente.portal.call(despachador.despachar) == 0
+    assert len(sela.almacen.backend.outbox) == 3
+
+    monkeypatch.setattr(sela, "cliente_http", httpx.AsyncClient(transport=httpx.MockTransport(outbox)))
+    for entrada in sela.almacen.backend.outbox.values():
+        entrada[2] = 0.0
+    assert cliente.portal.call(despachador.despachar) == 3
+
+    primero, reintento = outbox.lotes
+    assert [e["operacion_id"] for e in reintento] == [e["operacion_id"] for e in primero]
+    assert {e["operacion_id"] for e in eventos} == outbox.registrados
+    assert despachador.metricas["duplicados"] == 3
+    assert despachador.metricas["enviados"] == 3
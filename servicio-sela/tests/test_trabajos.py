@@ -0,0 +1,89 @@
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+import pytest
+
+import app as sela
+
+
+class AnonimizacionFalsa:
+    """/anonimizar/lote simulado: tarda `retardo` s por envío y devuelve los registros tal cual"""
+
+    def __init__(self, retardo=0, cuerpo=None):
+        self.retardo = retardo
+        self.cuerpo = cuerpo
+        self.envios = 0
+
+    async def __call__(self, peticion):
+        await asyncio.sleep(self.retardo)
+        self.envios += 1
+        registros = json.loads(peticion.content)["registros"]
+        cuerpo = self.cuerpo or {"datos_anonimizados": registros, "errores": []}
+        return httpx.Response(200, json={"operacion_id": str(uuid.uuid4()), **cuerpo})
+
+
+@pytest.fixture
+def entorno(monkeypatch):
+    monkeypatch.setattr(sela, "almacen", sela.Almacenamiento(sela.AlmacenMemoria()))
+
+    def configurar(anonimizacion):
+        monkeypatch.setattr(sela, "cliente_http", httpx.AsyncClient(transport=httpx.MockTransport(anonimizacion)))
+    return configurar
+
+
+def operacion(acuerdo_id="acuerdo", registros=1):
+    return {"id": str(uuid.uuid4()), "acuerdo_id": acuerdo_id, "operacion": "prueba",
+            "registros": registros, "estado": "en_progreso"}
+
+
+def test_detener_drena_la_cola_antes_de_cancelar(entorno):
+    entorno(AnonimizacionFalsa(retardo=0.05))
+
+    async def escenario():
+        cola = sela.ColaTrabajos(10, concurrencia=1, lote=1, max_registros=100, timeout=5)
+        cola.iniciar()
+        encolados = [await cola.encolar(operacion(), [{"dato": i}], {}) for i in range(3)]
+        inicio = time.monotonic()
+        await cola.detener(2)
+        return cola, encolados, time.monotonic() - inicio
+
+    cola, encolados, duracion = asyncio.run(escenario())
+    assert duracion < 1
+    assert cola.metricas["completadas"] == 3 and cola.metricas["errores"] == 0
+    assert all(trabajo.operacion["estado"] == "completada" for trabajo in encolados)
+
+
+def test_detenida_no_acepta_operaciones(entorno):
+    entorno(AnonimizacionFalsa())
+
+    async def escenario():
+        cola = sela.ColaTrabajos(10, concurrencia=1, lote=1, max_registros=100, timeout=5)
+        cola.iniciar()
+        await cola.detener(1)
+        with pytest.raises(sela.ColaTrabajosLlena):
+            await cola.encolar(operacion(), [{}], {})
+
+    asyncio.run(escenario())
+
+
+def test_grupo_que_falla_no_bloquea_al_resto_del_lote(entorno):
+    # Un índice de error mal formado hace fallar el reparto del resultado
+    entorno(AnonimizacionFalsa(cuerpo={"datos_anonimizados": [None], "errores": [{"motivo": "?"}]}))
+
+    async def escenario():
+        cola = sela.ColaTrabajos(10, concurrencia=1, lote=10, max_registros=100, timeout=5)
+        # Los dos acuerdos forman grupos distintos dentro del mismo lote
+        cola.iniciar()
+        encolados = [await cola.encolar(operacion(acuerdo_id), [{}], {}) for acuerdo_id in ("a", "b")]
+        for trabajo in encolados:
+            await asyncio.wait_for(trabajo.terminado.wait(), 2)
+        await cola.detener(1)
+        return cola, encolados
+
+    cola, encolados = asyncio.run(escenario())
+    assert [trabajo.operacion["estado"] for trabajo in encolados] == ["error", "error"]
+    assert not cola.activos
+    assert cola.metricas["errores"] == 2